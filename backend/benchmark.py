@@ -0,0 +1,348 @@
+'''
+Load and latency benchmark of the trivia API.
+
+Seeds a synthetic corpus of questions across the categories of
+trivia.psql, then drives the read and quiz endpoints through the Flask
+test client or a real threaded WSGI server and prints a JSON report with
+the p50/p95/p99 latency and throughput of every scenario and the peak
+RSS of the process. The adaptive quiz index and the quiz pools can also
+be timed alone, per pick, at growing corpus sizes, along with the memory
+of the pools:
+
+    python benchmark.py --questions 100000 --requests 2000 --concurrency 8
+    python benchmark.py --requests 0 --quiz-index-sizes 10000,100000,1000000
+    python benchmark.py --server wsgi \
+        --database-url postgres://localhost:5432/trivia_bench
+'''
+import argparse
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from flaskr.bulk import read_dump, import_questions
+from flaskr.quiz import DifficultyIndex, QuizPools, DIFFICULTIES
+from models import db, Category
+
+DUMP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'trivia.psql')
+
+WORDS = ('river', 'mountain', 'painter', 'novel', 'planet', 'empire',
+         'symphony', 'battle', 'island', 'element', 'champion', 'desert',
+         'inventor', 'temple', 'comet', 'harbor', 'poet', 'volcano',
+         'dynasty', 'galaxy', 'stadium', 'opera', 'glacier', 'molecule')
+
+
+def seed_corpus(size, rng):
+    '''
+    fills the database with the categories of trivia.psql and synthetic
+    questions until it holds `size` questions
+    '''
+    if not Category.categories_map():
+        for table, rows in read_dump(DUMP_PATH):
+            if table == 'categories':
+                db.session.execute(
+                    Category.__table__.insert(),
+                    [{'id': int(row['id']), 'type': row['type']}
+                     for row in rows])
+        Category.invalidate_cache()
+
+    categories = list(Category.categories_map())
+    missing = size - Category.count_questions()
+
+    def records():
+        for number in range(1, missing + 1):
+            yield number, {
+                'question': 'Which {} is the {} of the {} {}?'.format(
+                    *rng.sample(WORDS, 3), number),
+                'answer': ' '.join(rng.sample(WORDS, 2)),
+                'category': rng.choice(categories),
+                'difficulty': rng.randint(1, 5)
+            }, None
+
+    if missing > 0:
+        import_questions(records())
+
+    return categories
+
+
+def scenarios(categories, size):
+    '''
+    request generators of every benchmarked endpoint, each one returning
+    a (method, path, json body) tuple
+    '''
+    pages = max(1, size // QUESTIONS_PER_PAGE)
+    per_category = max(1, size // len(categories) // QUESTIONS_PER_PAGE)
+
+    def quiz_body(rng):
+        return {
+            'previous_questions': rng.sample(range(1, size + 1),
+                                             min(size, 20)),
+            'quiz_category': {'id': rng.choice([0] + categories)}
+        }
+
+    return {
+        'questions_page': lambda rng: (
+            'GET', '/questions?page={}'.format(
+                rng.randint(1, min(pages, 100))), None),
+        'questions_deep_page': lambda rng: (
+            'GET', '/questions?page={}'.format(rng.randint(1, pages)), None),
+        'questions_after_id': lambda rng: (
+            'GET', '/questions?after_id={}'.format(
+                rng.randint(0, max(0, size - QUESTIONS_PER_PAGE))), None),
+        'category_questions': lambda rng: (
+            'GET', '/categories/{}/questions?page={}'.format(
+                rng.choice(categories), rng.randint(1, per_category)), None),
+        'search': lambda rng: (
+            'POST', '/questions_by_phrase',
+            {'searchTerm': ' '.join(rng.sample(WORDS, 2))}),
+        'quizzes': lambda rng: ('POST', '/quizzes', quiz_body(rng)),
+        'quizzes_adaptive': lambda rng: ('POST', '/quizzes', dict(
+            quiz_body(rng), adaptive=True,
+            recent_answers=[rng.random() < 0.5 for _ in range(5)])),
+    }
+
+
+def test_client_sender(app):
+    local = threading.local()
+
+    def send(method, path, body):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        return local.client.open(path, method=method, json=body).status_code
+
+    return send, lambda: None
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def wsgi_sender(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def send(method, path, body):
+        connection = HTTPConnection('127.0.0.1', server.server_port)
+        try:
+            headers = {'Content-Type': 'application/json'}
+            connection.request(method, path, headers=headers,
+                               body=json.dumps(body) if body else None)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    return send, server.shutdown
+
+
+def percentile(values, fraction):
+    '''
+    nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run_scenario(send, make_request, requests, concurrency, seed):
+    rng = random.Random(seed)
+    planned = [make_request(rng) for _ in range(requests)]
+    latencies = []
+    errors = []
+
+    def timed(request):
+        started = time.perf_counter()
+        status = send(*request)
+        latencies.append(time.perf_counter() - started)
+        if status >= 500:
+            errors.append(status)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, planned))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': requests / elapsed if elapsed else None
+    }
+
+
+def quiz_index_latency(sizes, picks=10000, seed=0):
+    '''
+    build time and per-pick latency of the adaptive quiz index filled
+    with synthetic questions, for every corpus size
+    '''
+    rng = random.Random(seed)
+    categories = list(range(1, 7))
+    results = {}
+
+    for size in sizes:
+        index = DifficultyIndex()
+        started = time.perf_counter()
+        index.build((question_id, rng.choice(categories),
+                     rng.choice(DIFFICULTIES))
+                    for question_id in range(1, size + 1))
+        build_seconds = time.perf_counter() - started
+
+        latencies = []
+        for _ in range(picks):
+            category = rng.choice([0] + categories)
+            difficulty = rng.choice(DIFFICULTIES)
+            exclude = set(rng.sample(range(1, size + 1), min(size, 20)))
+            started = time.perf_counter()
+            index.pick(category, difficulty, exclude)
+            latencies.append(time.perf_counter() - started)
+
+        latencies.sort()
+        results[size] = {
+            'build_seconds': build_seconds,
+            'p50_us': percentile(latencies, 0.50) * 1e6,
+            'p99_us': percentile(latencies, 0.99) * 1e6
+        }
+
+    return results
+
+
+def quiz_pool_latency(sizes, picks=10000, seed=0):
+    '''
+    build time, per-pick latency and id buffer memory of the quiz pools
+    filled with synthetic questions, for every corpus size
+    '''
+    rng = random.Random(seed)
+    categories = list(range(1, 7))
+    results = {}
+
+    for size in sizes:
+        pools = QuizPools()
+        started = time.perf_counter()
+        pools.build((question_id, rng.choice(categories))
+                    for question_id in range(1, size + 1))
+        build_seconds = time.perf_counter() - started
+
+        latencies = []
+        for _ in range(picks):
+            category = rng.choice([0] + categories)
+            exclude = set(rng.sample(range(1, size + 1), min(size, 20)))
+            started = time.perf_counter()
+            pools.pick(category, exclude)
+            latencies.append(time.perf_counter() - started)
+
+        latencies.sort()
+        results[size] = {
+            'build_seconds': build_seconds,
+            'p50_us': percentile(latencies, 0.50) * 1e6,
+            'p99_us': percentile(latencies, 0.99) * 1e6,
+            'bytes': pools.nbytes(),
+            'bytes_per_million_questions': pools.nbytes() * 1e6 / size
+        }
+
+    return results
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_benchmark(database_url, questions=10000, requests=1000,
+                  concurrency=1, server='test-client', only=None, seed=0,
+                  quiz_index_sizes=None):
+    '''
+    seeds the corpus and runs every scenario (or those in `only`), then
+    times the quiz index and pools at quiz_index_sizes; returns the JSON
+    report as a dictionary
+    '''
+    app = create_app({'DATABASE_URL': database_url})
+    rng = random.Random(seed)
+
+    with app.app_context():
+        started = time.perf_counter()
+        db.create_all()
+        categories = seed_corpus(questions, rng)
+        seed_seconds = time.perf_counter() - started
+
+    sender, stop = wsgi_sender(app) if server == 'wsgi' \
+        else test_client_sender(app)
+    report = {
+        'config': {
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+            'questions': questions,
+            'requests': requests,
+            'concurrency': concurrency,
+            'server': server
+        },
+        'seed_seconds': seed_seconds,
+        'scenarios': {}
+    }
+
+    try:
+        for name, make_request in scenarios(categories, questions).items():
+            if not requests or (only and name not in only):
+                continue
+            report['scenarios'][name] = run_scenario(
+                sender, make_request, requests, concurrency, seed)
+    finally:
+        stop()
+
+    if quiz_index_sizes:
+        report['quiz_index'] = quiz_index_latency(quiz_index_sizes,
+                                                  seed=seed)
+        report['quiz_pools'] = quiz_pool_latency(quiz_index_sizes,
+                                                 seed=seed)
+    report['peak_rss_kb'] = peak_rss_kb()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database-url', default='sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'trivia_benchmark.db'))
+    parser.add_argument('--questions', type=int, default=10000,
+                        help='corpus size, from 10k to 1M questions')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--server', choices=('test-client', 'wsgi'),
+                        default='test-client')
+    parser.add_argument('--scenario', action='append', dest='only',
+                        help='only run this scenario, can be repeated')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quiz-index-sizes', type=lambda value: [
+        int(size) for size in value.split(',')],
+        help='comma separated corpus sizes to time quiz index and pool '
+        'picks at')
+    parser.add_argument('--output', help='write the report to this file')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.database_url, args.questions, args.requests,
+                           args.concurrency, args.server, args.only,
+                           args.seed, args.quiz_index_sizes)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
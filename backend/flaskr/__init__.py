@@ -1,32 +1,136 @@
 import os
-from flask import Flask, request, abort, jsonify
+import time
+import click
+from flask import Flask, request, abort, jsonify, Response, g, \
+    stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
+from models import db, setup_db, config_setting, Question, Category, Job, \
+    Upload, Version
+from .quiz import select_random_question, select_adaptive_question, \
+    draw_deck, QuizSessionStore, SESSION_QUESTIONS
+from .search import search_backend, suggestion_index, SUGGESTIONS, \
+    MAX_SUGGESTIONS
+from .caching import conditional
+from .response_cache import init_response_cache
+from .warmup import warm_up
+from .replicas import init_read_routing
+from .rooms import RoomStore, RoomError, room_event_stream, ROOM_QUESTIONS, \
+    MAX_ROOM_QUESTIONS
+from .admission import init_admission_control, retry_after_headers
+from .instrumentation import init_instrumentation
+from .batch import apply_operations
+from .jobs import JOB_STATUSES, MAINTENANCE_JOBS, valid_job_arguments, \
+    submit_job, run_pending, init_job_runner
+from .encoding import QUESTION_COLUMNS, question_dicts, string_keys, \
+    json_response
+from .bulk import READERS, CONTENT_TYPES, COPY_COLUMNS, EXPORT_MIMETYPES, \
+    BulkImportError, iter_lines, import_questions, export_questions
 
 QUESTIONS_PER_PAGE = 10
 
+# response fields of the question listings, full and with `view=minimal`
+LIST_FIELDS = ('questions', 'total_questions', 'current_category',
+               'categories')
+LIST_MINIMAL_FIELDS = ('questions', 'total_questions')
+
 
 def paginate_questions(request, selection):
     '''
-    questions paginator
+    questions paginator, runs LIMIT/OFFSET (or an `after_id` keyset
+    cursor for deep pages) in the database over an ordered query of
+    QUESTION_COLUMNS
+    '''
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None:
+        selection = selection.filter(Question.id > after_id)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return []
+        selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    return question_dicts(selection.limit(QUESTIONS_PER_PAGE))
+
+
+def question_listing():
+    '''
+    QUESTION_COLUMNS tuples of every question, ordered by id
+    '''
+    return Question.query.with_entities(*QUESTION_COLUMNS).\
+        order_by(Question.id)
+
+
+def current_categories(questions):
     '''
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    categories of a page of formatted questions
+    '''
+    return list(set([question['category'] for question in questions]))
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
 
-    return current_questions
+def response_fields(request, fields, minimal_fields):
+    '''
+    names of the response fields a client asked for, either listed in
+    `fields=` (comma separated) or with `view=minimal`; all by default
+    '''
+    requested = request.args.get('fields')
+    if requested:
+        requested = requested.split(',')
+        return [name for name in fields if name in requested]
+    if request.args.get('view') == 'minimal':
+        return list(minimal_fields)
+
+    return list(fields)
+
+
+def shape_response(fields, builders):
+    '''
+    success payload holding the given fields, each one computed by its
+    builder only when it is returned
+    '''
+    response = {
+        "success": True,
+        "status_code": 200,
+        "status_message": 'OK'
+    }
+    for name in fields:
+        response[name] = builders[name]()
+
+    return response
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    # opt-in read replicas for the read-only requests
+    init_read_routing(app)
+
+    quiz_sessions = QuizSessionStore(
+        ttl=app.config.get('QUIZ_SESSION_TTL', 3600))
+    # questions drawn per session, bounding the memory of the store
+    session_questions = config_setting(app, 'QUIZ_SESSION_QUESTIONS',
+                                       SESSION_QUESTIONS, type=int)
+    # shared with the ASGI app, which streams the room events itself
+    quiz_rooms = app.extensions['quiz_rooms'] = RoomStore(
+        ttl=config_setting(app, 'ROOM_TTL', 3600, type=int),
+        keepalive=config_setting(app, 'ROOM_KEEPALIVE', 15, type=float))
+
+    # opt-in cache of the read responses, shared by the workers or not
+    init_response_cache(app)
+
+    # opt-in query counts, timings and /metrics
+    if config_setting(app, 'INSTRUMENTATION', False, type=bool):
+        init_instrumentation(app)
+
+    # opt-in rate limits and concurrency bound of the quiz and search
+    init_admission_control(app)
+
+    # opt-in worker threads running the queued background jobs
+    init_job_runner(app)
 
     '''
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after
@@ -42,7 +146,7 @@ def create_app(test_config=None):
         response.headers.add("Access-Control-Allow-Headers",
                              "Content-Type,Authorization,true")
         response.headers.add("Access-Control-Allow-Methods",
-                             "GET,PUT,POST,DELETE,OPTIONS")
+                             "GET,PUT,POST,PATCH,DELETE,OPTIONS")
         response.headers.add("Access-Control-Allow-Credentials", "true")
         return response
 
@@ -52,20 +156,21 @@ def create_app(test_config=None):
     for all available categories.
     '''
     @app.route('/categories')
+    @conditional
     def retrieve_categories():
         try:
-            categories = Category.query.order_by(Category.id).all()
-            cat_items = [(
-                category.id, category.type) for category in categories]
-            if len(cat_items) == 0:
+            categories = Category.categories_map()
+            if len(categories) == 0:
                 abort(404)
 
             else:
-                return jsonify({
+                return json_response({
                     "success": True,
                     "status_code": 200,
                     "status_message": 'OK',
-                    "categories": {key: value for (key, value) in cat_items},
+                    "categories": string_keys(categories),
+                    "question_counts": string_keys(
+                        Category.question_counts()),
                     "total_categories": len(categories)
                 })
 
@@ -86,26 +191,25 @@ def create_app(test_config=None):
     Clicking on the page numbers should update the questions.
     '''
     @app.route('/questions')
+    @conditional
     def retrieve_questions():
         try:
-            questions = Question.query.order_by(Question.id).all()
+            questions = question_listing()
             current_questions = paginate_questions(request, questions)
-            categories = Category.query.order_by(Category.id).all()
-            cat_items = [(
-                category.id, category.type) for category in categories]
 
             if len(current_questions) == 0:
                 abort(404)
 
-            return jsonify({
-                "success": True,
-                "status_code": 200,
-                "status_message": 'OK',
-                "questions": current_questions,
-                "total_questions": len(questions),
-                "current_category": list(set([question['category'] for question in current_questions])),  # noqa
-                "categories": {key: value for (key, value) in cat_items}
-            })
+            fields = response_fields(request, LIST_FIELDS,
+                                     LIST_MINIMAL_FIELDS)
+            return json_response(shape_response(fields, {
+                "questions": lambda: current_questions,
+                "total_questions": Category.count_questions,
+                "current_category": lambda: current_categories(
+                    current_questions),
+                "categories": lambda: string_keys(
+                    Category.categories_map())
+            }))
 
         except Exception:
             abort(422)
@@ -121,24 +225,22 @@ def create_app(test_config=None):
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
         try:
-            question = Question.query.filter(
-                Question.id == question_id).one_or_none()
-
-            if question is None:
+            # a single DELETE statement, without loading the question first
+            changes, errors = apply_operations([{'op': 'delete',
+                                                 'id': question_id}])
+            if not changes['deleted']:
                 abort(404)
-            else:
-                question.delete()
-                questions = question.query.order_by(Question.id).all()
-                current_questions = paginate_questions(request, questions)
 
-            return jsonify({
-                "success": True,
-                "status_code": 200,
-                "status_message": 'OK',
-                "deleted": question_id,
-                "questions": current_questions,
-                "total_questions": len(questions)
-            })
+            # `view=minimal` only returns the deleted id
+            fields = response_fields(
+                request, ('deleted', 'questions', 'total_questions'),
+                ('deleted',))
+            return json_response(shape_response(fields, {
+                "deleted": lambda: question_id,
+                "questions": lambda: paginate_questions(
+                    request, question_listing()),
+                "total_questions": Category.count_questions
+            }))
 
         except Exception:
             abort(422)
@@ -168,6 +270,13 @@ def create_app(test_config=None):
                     or category == ''\
                     or dificulty == '':
                 abort(422)
+            # every question belongs to a known category, as in bulk writes
+            try:
+                category = int(category)
+            except (TypeError, ValueError):
+                abort(422)
+            if category not in Category.categories_map():
+                abort(422)
 
             try:
                 new_question = Question(question=question,
@@ -180,37 +289,144 @@ def create_app(test_config=None):
                 question, answer, category, dificulty = '', '', '', ''
                 body.clear()
 
-                questions = Question.query.order_by(Question.id).all()
-                current_questions = paginate_questions(request, questions)
-
-                categories = Category.query.order_by(Category.id).all()
-                cat_items = [(
-                    category.id, category.type) for category in categories]
-
-                if len(current_questions) == 0:
-                    abort(404)
-
-                return jsonify({
-                    "success": True,
-                    "status_code": 200,
-                    "status_message": "OK",
-                    "questions": current_questions,
-                    "total_questions": len(questions),
-                    "current_category": list(set([question['category'] for question in current_questions])),  # noqa
-                    "categories": {key: value for (key, value) in cat_items}
-                })
+                # `view=minimal` only returns the created id, without
+                # listing a page of questions again
+                fields = response_fields(request,
+                                         ('created',) + LIST_FIELDS,
+                                         ('created',))
+
+                current_questions = []
+                if 'questions' in fields or 'current_category' in fields:
+                    questions = question_listing()
+                    current_questions = paginate_questions(request,
+                                                           questions)
+                    if len(current_questions) == 0:
+                        abort(404)
+
+                return json_response(shape_response(fields, {
+                    "created": lambda: new_question.id,
+                    "questions": lambda: current_questions,
+                    "total_questions": Category.count_questions,
+                    "current_category": lambda: current_categories(
+                        current_questions),
+                    "categories": lambda: string_keys(
+                        Category.categories_map())
+                }))
 
             except Exception:
                 abort(422)
         else:
             abort(422)
 
+    '''
+    Batched writes: a list of create, update and delete operations applied
+    in one transaction, all of them or none.
+    '''
+    @app.route('/questions', methods=['PATCH'])
+    def batch_questions():
+        body = request.get_json()
+        operations = body.get('operations') if isinstance(body, dict) \
+            else None
+        if not isinstance(operations, list):
+            abort(400)
+
+        try:
+            changes, errors = apply_operations(operations)
+        except Exception:
+            abort(422)
+
+        if errors:
+            return jsonify({
+                "success": False,
+                "error": 422,
+                "message": "Unprocessable",
+                "errors": errors
+            }), 422
+
+        return jsonify({
+            "success": True,
+            "status_code": 200,
+            "status_message": "OK",
+            "created": changes['created'],
+            "updated": changes['updated'],
+            "deleted": changes['deleted']
+        })
+
+    '''
+    Bulk import of questions streamed in the request body as NDJSON, CSV
+    or PostgreSQL COPY text (as in trivia.psql), inserted in batches.
+    With `background=true` the body is queued as an import job instead.
+    '''
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_import_questions():
+        import_format = request.args.get('format',
+                                         CONTENT_TYPES.get(request.mimetype))
+        if import_format not in READERS:
+            abort(400)
+        columns = request.args.get('columns')
+        columns = columns.split(',') if columns else COPY_COLUMNS
+
+        if request.args.get('background', 'false').lower() in ('1', 'true'):
+            # the body is staged in the same transaction as the job
+            queued = submit_job('import_questions', {
+                'import_format': import_format,
+                'upload': Upload.store(request.stream),
+                'columns': columns
+            })
+            return jsonify({
+                "success": True,
+                "status_code": 202,
+                "status_message": "Accepted",
+                "job": queued.format()
+            }), 202
+
+        lines = iter_lines(request.stream)
+        if import_format == 'copy':
+            records = READERS['copy'](lines, columns)
+        else:
+            records = READERS[import_format](lines)
+
+        try:
+            inserted, rejected, errors = import_questions(records)
+        except BulkImportError as e:
+            # the batches before the failure stay committed
+            return jsonify({
+                "success": False,
+                "error": 422,
+                "message": "Unprocessable",
+                "inserted": e.inserted,
+                "rejected": e.rejected,
+                "errors": e.errors
+            }), 422
+
+        return jsonify({
+            "success": True,
+            "status_code": 200,
+            "status_message": "OK",
+            "inserted": inserted,
+            "rejected": rejected,
+            "errors": errors
+        })
+
+    @app.route('/questions/export')
+    def export_all_questions():
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_MIMETYPES:
+            abort(400)
+
+        mimetype = EXPORT_MIMETYPES[export_format]
+        return Response(stream_with_context(export_questions(export_format)),
+                        mimetype=mimetype)
+
     '''
     @TODO:
     Create a POST endpoint to get questions based on a search term.
     It should return any questions for whom the search term
     is a substring of the question.
 
+    Every word of the search term matches as a word prefix, through the
+    PostgreSQL full-text index or the in-memory inverted index elsewhere.
+
     TEST: Search by any phrase. The questions list will update to include
     only question that include that string within their question.
     Try using the word "title" to start.
@@ -218,34 +434,54 @@ def create_app(test_config=None):
     @app.route('/questions_by_phrase', methods=['POST'])
     def questions_search():
         body = request.get_json()
-        phrase = '%{}%'.format(body.get('searchTerm'))
+        phrase = body.get('searchTerm')
+        include_answers = bool(body.get('searchAnswers', False))
 
         try:
-            questions = Question.query.filter(Question.question.
-                                              ilike(phrase)).\
-                                              order_by(Question.id).all()
-            current_questions = paginate_questions(request, questions)
+            page = request.args.get('page', 1, type=int)
+            if page < 1:
+                abort(404)
 
-            categories = Category.query.order_by(Category.id).all()
-            cat_items = [(
-                category.id, category.type) for category in categories]
+            current_questions, total_questions = search_backend().search(
+                phrase, include_answers,
+                offset=(page - 1) * QUESTIONS_PER_PAGE,
+                limit=QUESTIONS_PER_PAGE)
 
             if len(current_questions) == 0:
                 abort(404)
 
-            return jsonify({
-                "success": True,
-                'status_code': 200,
-                "status_message": "OK",
-                "questions": current_questions,
-                "total_questions": len(questions),
-                "current_category": list(set([question['category'] for question in current_questions])),  # noqa
-                "categories": {key: value for (key, value) in cat_items}
-            })
+            fields = response_fields(request, LIST_FIELDS,
+                                     LIST_MINIMAL_FIELDS)
+            return json_response(shape_response(fields, {
+                "questions": lambda: current_questions,
+                "total_questions": lambda: total_questions,
+                "current_category": lambda: current_categories(
+                    current_questions),
+                "categories": lambda: string_keys(
+                    Category.categories_map())
+            }))
 
         except Exception:
             abort(400)
 
+    '''
+    Type-ahead suggestions for the search box: completions of the last
+    word of `prefix` among the words of the questions.
+    '''
+    @app.route('/questions/suggest')
+    def suggest_questions():
+        prefix = request.args.get('prefix', '')
+        limit = request.args.get('limit', SUGGESTIONS, type=int)
+        if not 1 <= limit <= MAX_SUGGESTIONS:
+            abort(400)
+
+        return jsonify({
+            "success": True,
+            "status_code": 200,
+            "status_message": "OK",
+            "suggestions": suggestion_index().suggest(prefix, limit)
+        })
+
     '''
     @TODO:
     Create a GET endpoint to get questions based on category.
@@ -255,30 +491,29 @@ def create_app(test_config=None):
     category to be shown.
     '''
     @app.route('/categories/<int:category_id>/questions')
+    @conditional
     def questions_by_cat(category_id):
         try:
-            questions = Question.query.filter(Question.category ==
-                                              category_id).\
-                                              order_by(Question.id).all()
+            questions = question_listing().filter(Question.category ==
+                                                  category_id)
             current_questions = paginate_questions(request, questions)
 
-            categories = Category.query.filter(Category.id == category_id).\
-                order_by(Category.id).all()
-            cat_items = [(
-                category.id, category.type) for category in categories]
-
             if len(current_questions) == 0:
                 abort(404)
 
-            return jsonify({
-                "success": True,
-                "status_code": 200,
-                "status_message": "OK",
-                "questions": current_questions,
-                "total_questions": len(questions),
-                "current_category": list(set([question['category'] for question in current_questions])),  # noqa
-                "categories": {key: value for (key, value) in cat_items}
-            })
+            fields = response_fields(request, LIST_FIELDS,
+                                     LIST_MINIMAL_FIELDS)
+            return json_response(shape_response(fields, {
+                "questions": lambda: current_questions,
+                "total_questions": lambda: Category.count_questions(
+                    category_id),
+                "current_category": lambda: current_categories(
+                    current_questions),
+                "categories": lambda: string_keys({
+                    key: value for (key, value)
+                    in Category.categories_map().items()
+                    if key == category_id})
+            }))
 
         except Exception:
             abort(422)
@@ -297,53 +532,336 @@ def create_app(test_config=None):
     @app.route('/quizzes', methods=['POST'])
     def play_quiz():
         body = request.get_json()
-        category = body.get('quiz_category').get('id')
-        prev_question = body.get('previous_questions')
 
-        # play on all categories or an specific one:
-        if category != 0:
-            questions = Question.query.filter(Question.category == category)\
-                                  .all()
-        else:
-            questions = Question.query.order_by(Question.id).all()
+        try:
+            category = int(body.get('quiz_category').get('id'))
+            prev_question = body.get('previous_questions') or []
+            if body.get('adaptive'):
+                # recent answers of the player, True for correct ones
+                recent_answers = body.get('recent_answers') or []
+                if not isinstance(recent_answers, list):
+                    abort(400)
+                current_question = select_adaptive_question(
+                    category, prev_question, recent_answers)
+            else:
+                current_question = select_random_question(category,
+                                                          prev_question)
+        except Exception:
+            abort(400)
+
+        # no question at all in the requested category
+        if current_question is None and len(prev_question) == 0:
+            abort(404)
+
+        # every question was already asked: a null question ends the game
+        if current_question is not None:
+            current_question = current_question.format()
+
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "question": current_question
+        })
+
+    '''
+    Quiz sessions: the category is read once when the session starts and
+    its shuffled deck of question ids is kept server side, so asking for
+    the next question does not need the previous questions list.
+    '''
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
+        body = request.get_json()
 
-        questions = [question.format() for question in questions]
+        try:
+            category = int(body.get('quiz_category').get('id'))
+            deck = draw_deck(category, session_questions)
+        except Exception:
+            abort(400)
 
-        if len(questions) == 0:
+        if len(deck) == 0:
             abort(404)
-        current_question = random.choice(questions)
-        keep_playing = True
 
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "session_id": quiz_sessions.create(deck),
+                "total_questions": len(deck)
+        })
+
+    @app.route('/quizzes/sessions/<session_id>/next')
+    def next_session_question(session_id):
         try:
-            while keep_playing:
-                if current_question.get('id') not in prev_question:
-                    return jsonify({
-                            "success": True,
-                            "status_code": 200,
-                            "status_message": "OK",
-                            "question": current_question
-                        })
-                else:
-                    if len(questions) > len(prev_question):
-                        current_question = random.choice(questions)
-                    else:
-                        keep_playing = False
+            current_question = None
+            question_id, remaining = quiz_sessions.pop(session_id)
+            # skip the questions deleted since the deck was drawn
+            while question_id is not None and current_question is None:
+                current_question = Question.query.get(question_id)
+                if current_question is None:
+                    question_id, remaining = quiz_sessions.pop(session_id)
+        except KeyError:
+            abort(404)
 
-            return jsonify({
-                    "success": True,
-                    "status_code": 200,
-                    "status_message": "OK",
-                    "question": current_question
-            })
+        if current_question is not None:
+            current_question = current_question.format()
 
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "question": current_question,
+                "remaining_questions": remaining
+        })
+
+    '''
+    Quiz rooms: every player of a room gets the same questions, drawn
+    once from the category when the host creates the room and pushed to
+    the players as Server-Sent Events. The host moves to the next
+    question, read once for the whole room, and the answers are tallied
+    in memory.
+    '''
+    def find_room(room_id):
+        try:
+            return quiz_rooms.get(room_id)
+        except KeyError:
+            abort(404)
+
+    @app.route('/rooms', methods=['POST'])
+    def create_room():
+        body = request.get_json()
+
+        try:
+            category = int(body.get('quiz_category').get('id'))
+            questions = int(body.get('questions', ROOM_QUESTIONS))
+            if not 1 <= questions <= MAX_ROOM_QUESTIONS:
+                abort(400)
+            # only the ids the room keeps are drawn
+            deck = draw_deck(category, questions)
         except Exception:
             abort(400)
 
+        if len(deck) == 0:
+            abort(404)
+
+        room = quiz_rooms.create(category, deck)
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "room_id": room.id,
+                "host_token": room.host_token,
+                "total_questions": len(room.sequence)
+        })
+
+    @app.route('/rooms/<room_id>')
+    def retrieve_room(room_id):
+        state = find_room(room_id).state()
+        state.update({
+            "success": True,
+            "status_code": 200,
+            "status_message": "OK"
+        })
+        return jsonify(state)
+
+    @app.route('/rooms/<room_id>/players', methods=['POST'])
+    def join_room(room_id):
+        room = find_room(room_id)
+        body = request.get_json()
+
+        name = body.get('name') if isinstance(body, dict) else None
+        if not isinstance(name, str) or not name.strip():
+            abort(400)
+        try:
+            player_id = room.join(name.strip())
+        except RoomError:
+            abort(422)
+
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "player_id": player_id
+        })
+
+    @app.route('/rooms/<room_id>/next', methods=['POST'])
+    def next_room_question(room_id):
+        room = find_room(room_id)
+        body = request.get_json()
+
+        if not isinstance(body, dict) or \
+                not room.is_host(body.get('host_token')):
+            abort(403)
+        try:
+            current_question = room.next_question()
+        except RoomError:
+            abort(422)
+
+        # a null question ends the game
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "question": current_question,
+                "question_number": room.position,
+                "total_questions": len(room.sequence)
+        })
+
+    @app.route('/rooms/<room_id>/answers', methods=['POST'])
+    def answer_room_question(room_id):
+        room = find_room(room_id)
+        body = request.get_json()
+
+        if not isinstance(body, dict) or \
+                not isinstance(body.get('answer'), str):
+            abort(400)
+        try:
+            correct = room.answer(body.get('player_id'), body['answer'])
+        except KeyError:
+            abort(403)
+        except RoomError:
+            abort(422)
+
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "correct": correct
+        })
+
+    @app.route('/rooms/<room_id>/events')
+    def room_events(room_id):
+        room = find_room(room_id)
+        # a reconnecting EventSource resumes after the last event it got
+        cursor = request.headers.get('Last-Event-ID', 0, type=int)
+
+        return Response(room_event_stream(room, cursor, quiz_rooms.keepalive),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+    '''
+    Background jobs: maintenance over the questions table, queued in the
+    jobs table and run in batches by the job workers of any process.
+    '''
+    @app.route('/jobs', methods=['POST'])
+    def create_job():
+        body = request.get_json()
+
+        if not isinstance(body, dict) or \
+                body.get('kind') not in MAINTENANCE_JOBS:
+            abort(400)
+        # keyword arguments of the job function, such as batch_size
+        arguments = body.get('arguments') or {}
+        if not isinstance(arguments, dict) or \
+                not valid_job_arguments(body['kind'], arguments):
+            abort(400)
+
+        return jsonify({
+                "success": True,
+                "status_code": 202,
+                "status_message": "Accepted",
+                "job": submit_job(body['kind'], arguments).format()
+        }), 202
+
+    @app.route('/jobs')
+    def retrieve_jobs():
+        status = request.args.get('status')
+        page = request.args.get('page', 1, type=int)
+        if page < 1 or (status is not None and status not in JOB_STATUSES):
+            abort(400)
+
+        selection = Job.query
+        if status is not None:
+            selection = selection.filter(Job.status == status)
+        current_jobs = selection.order_by(Job.id.desc()).\
+            offset((page - 1) * QUESTIONS_PER_PAGE).\
+            limit(QUESTIONS_PER_PAGE).all()
+
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "jobs": [current_job.format() for current_job in current_jobs],
+                "total_jobs": selection.count()
+        })
+
+    @app.route('/jobs/<int:job_id>')
+    def retrieve_job(job_id):
+        current_job = Job.query.get(job_id)
+        if current_job is None:
+            abort(404)
+
+        return jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": "OK",
+                "job": current_job.format()
+        })
+
+    @app.cli.group()
+    def jobs():
+        '''Queue, list and run the background jobs.'''
+
+    @jobs.command('submit')
+    @click.argument('kind', type=click.Choice(list(MAINTENANCE_JOBS)))
+    def submit_job_command(kind):
+        '''Queue a maintenance job.'''
+        click.echo('Queued job {} ({})'.format(submit_job(kind).id, kind))
+
+    @jobs.command('run')
+    @click.option('--once', is_flag=True,
+                  help='Exit once the queue is empty.')
+    def run_jobs_command(once):
+        '''Run the queued jobs, then wait for new ones.'''
+        while True:
+            count = run_pending(
+                pause=config_setting(app, 'JOB_BATCH_PAUSE', 0.01,
+                                     type=float),
+                stale_after=config_setting(app, 'JOB_STALE_AFTER', 600,
+                                           type=float))
+            if once:
+                click.echo('Ran {} jobs'.format(count))
+                return
+            db.session.remove()
+            time.sleep(config_setting(app, 'JOB_POLL_INTERVAL', 5.0,
+                                      type=float))
+
+    @jobs.command('list')
+    def list_jobs_command():
+        '''Show the latest jobs.'''
+        for current_job in Job.query.order_by(Job.id.desc()).\
+                limit(QUESTIONS_PER_PAGE):
+            click.echo('{} {} {} {}/{}'.format(
+                current_job.id, current_job.kind, current_job.status,
+                current_job.progress,
+                '?' if current_job.total is None else current_job.total))
+
+    @app.cli.command('init-db')
+    def init_db():
+        '''Create the missing tables and indexes of the models.'''
+        db.create_all()
+        Version.seed()
+        # the URL repr hides the password
+        click.echo('Created the missing tables of {!r}'.format(
+            db.engine.url))
+
     '''
     @TODO:
     Create error handlers for all expected errors
     including 404 and 422.
     '''
+    @app.errorhandler(403)
+    def forbidden(error):
+        """
+        403 Error handler
+        """
+        return jsonify({
+            "success": False,
+            "error": 403,
+            "message": "Forbidden"
+        }), 403
+
     @app.errorhandler(404)
     def not_found(error):
         """
@@ -377,4 +895,30 @@ def create_app(test_config=None):
             "message": "Unprocessable"
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        """
+        429 Error handler
+        """
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too Many Requests"
+        }), 429, retry_after_headers(g.get('retry_after', 1))
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        """
+        503 Error handler
+        """
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service Unavailable"
+        }), 503, retry_after_headers(g.get('retry_after', 1))
+
+    # opt-in: connections, caches and indexes ready before the first request
+    if config_setting(app, 'WARM_UP', False, type=bool):
+        warm_up(app)
+
     return app
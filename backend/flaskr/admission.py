@@ -0,0 +1,241 @@
+import math
+import sqlite3
+import threading
+import time
+
+from flask import g, request, abort
+
+from models import config_setting
+
+# the DB-heavy POST endpoints, each request may load a whole category
+ADMISSION_ENDPOINTS = ('play_quiz', 'questions_search')
+# buckets kept in memory before dropping the ones full again
+MAX_BUCKETS = 10000
+# takes between two purges of the full buckets of a SQLite store
+PURGE_INTERVAL = 1000
+
+
+class MemoryBuckets:
+    '''
+    token buckets of one worker process, by key
+    '''
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''
+        takes a token from the bucket of `key`, refilled with `rate` tokens
+        per second up to `burst` tokens; returns 0 when a token was taken,
+        else the seconds until the next one
+        '''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            # a bucket full again is the same as no bucket
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets = {key: bucket for key, bucket
+                                 in self._buckets.items() if bucket[2] > now}
+
+        return wait
+
+
+class SQLiteBuckets:
+    '''
+    token buckets in a SQLite file, shared by the workers of a host
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.takes = 0
+        self._local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS rate_limits ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+            'updated REAL NOT NULL, full_at REAL NOT NULL)')
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # transactions are opened explicitly, see take
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        connection = self.connection()
+        # the write lock first, so concurrent workers cannot both spend
+        # the last token
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = connection.execute(
+                'SELECT tokens, updated FROM rate_limits WHERE key = ?',
+                (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            # the clocks of the workers may be slightly apart
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?)',
+                (key, tokens, now, now + (burst - tokens) / rate))
+            self.takes += 1
+            if self.takes % PURGE_INTERVAL == 0:
+                connection.execute(
+                    'DELETE FROM rate_limits WHERE full_at <= ?', (now,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return wait
+
+
+class ConcurrencyGate:
+    '''
+    bounds the requests running at once in a worker process; a request
+    waits up to `timeout` seconds for a free slot
+    '''
+
+    def __init__(self, limit, timeout=0.0):
+        self.limit = limit
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def acquire(self, blocking=True):
+        if blocking and self.timeout > 0:
+            return self._slots.acquire(timeout=self.timeout)
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+
+class AdmissionController:
+    '''
+    admits the requests of the admission endpoints: a token bucket per
+    client and route, one per route shared by every client, then a slot
+    of the concurrency gate. Rejected requests get a 429 or a 503 status
+    and the seconds after which to retry.
+    '''
+
+    def __init__(self, buckets, client_rate=None, client_burst=None,
+                 route_rate=None, route_burst=None, gate=None,
+                 retry_after=1.0, endpoints=ADMISSION_ENDPOINTS):
+        self.buckets = buckets
+        self.client_rate = client_rate
+        self.client_burst = client_burst or max(1.0, client_rate or 0)
+        self.route_rate = route_rate
+        self.route_burst = route_burst or max(1.0, route_rate or 0)
+        self.gate = gate
+        self.retry_after = retry_after
+        self.endpoints = endpoints
+
+    def check_rate(self, client, endpoint):
+        '''
+        seconds to wait before retrying, 0 when the rate limits admit the
+        request
+        '''
+        if self.client_rate:
+            wait = self.buckets.take('client:{}:{}'.format(endpoint, client),
+                                     self.client_rate, self.client_burst)
+            if wait:
+                return wait
+        if self.route_rate:
+            return self.buckets.take('route:{}'.format(endpoint),
+                                     self.route_rate, self.route_burst)
+
+        return 0
+
+    def admit(self, client, endpoint, blocking=True):
+        '''
+        (None, 0) when the request is admitted, holding a slot of the gate
+        if there is one, else its error status and retry delay
+        '''
+        wait = self.check_rate(client, endpoint)
+        if wait:
+            return 429, wait
+        if self.gate is not None and not self.gate.acquire(blocking):
+            return 503, self.retry_after
+
+        return None, 0
+
+    def release(self):
+        if self.gate is not None:
+            self.gate.release()
+
+
+def retry_after_headers(seconds):
+    # whole seconds, never 0 which would invite an immediate retry
+    return {'Retry-After': str(max(1, math.ceil(seconds)))}
+
+
+def rate_buckets(url):
+    '''
+    token bucket store of a RATE_LIMIT_STORE setting: `memory` or
+    `sqlite:///path/to/limits.db`
+    '''
+    if url == 'memory':
+        return MemoryBuckets()
+    if url.startswith('sqlite:///'):
+        return SQLiteBuckets(url[len('sqlite:///'):])
+
+    raise ValueError('unknown rate limit store {}'.format(url))
+
+
+def init_admission_control(app):
+    '''
+    sets up the admission controller of the RATE_LIMIT_* and
+    CONCURRENCY_* settings in front of the admission endpoints, if any
+    '''
+    client_rate = config_setting(app, 'RATE_LIMIT_CLIENT', type=float)
+    route_rate = config_setting(app, 'RATE_LIMIT_ROUTE', type=float)
+    concurrency = config_setting(app, 'CONCURRENCY_LIMIT', type=int)
+    if not (client_rate or route_rate or concurrency):
+        return None
+
+    controller = AdmissionController(
+        rate_buckets(config_setting(app, 'RATE_LIMIT_STORE', 'memory')),
+        client_rate=client_rate,
+        client_burst=config_setting(app, 'RATE_LIMIT_CLIENT_BURST',
+                                    type=float),
+        route_rate=route_rate,
+        route_burst=config_setting(app, 'RATE_LIMIT_ROUTE_BURST',
+                                   type=float),
+        gate=ConcurrencyGate(
+            concurrency,
+            config_setting(app, 'CONCURRENCY_TIMEOUT', 0.0, type=float)
+        ) if concurrency else None,
+        retry_after=config_setting(app, 'CONCURRENCY_RETRY_AFTER', 1.0,
+                                   type=float))
+    app.extensions['admission'] = controller
+
+    @app.before_request
+    def admit_request():
+        # requests handed over by the ASGI app were admitted there
+        if request.endpoint not in controller.endpoints or \
+                request.environ.get('trivia.admitted'):
+            return
+        status, g.retry_after = controller.admit(request.remote_addr,
+                                                 request.endpoint)
+        if status is not None:
+            abort(status)
+        g.admission_slot = True
+
+    @app.teardown_request
+    def release_slot(exception):
+        if g.pop('admission_slot', False):
+            controller.release()
+
+    return controller
@@ -0,0 +1,198 @@
+from collections import Counter
+
+from sqlalchemy import select, bindparam
+
+from models import db, Question, Category, Version, search_vector, \
+    notify_question_change
+from .bulk import BATCH_SIZE, validate_question, insert_statement
+
+# ids per IN (...) list, below the bound parameter limit of old SQLite
+ID_BATCH_SIZE = 500
+
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+
+def chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def read_operations(operations, categories):
+    '''
+    validated creates, updates and deletes of a list of operations, and
+    the errors of the invalid ones by list index
+    '''
+    creates, updates, deletes, errors = [], [], [], []
+
+    for index, operation in enumerate(operations):
+        try:
+            if not isinstance(operation, dict):
+                raise ValueError('expected a JSON object')
+
+            action = operation.get('op')
+            if action not in ('create', 'update', 'delete'):
+                raise ValueError('op must be create, update or delete')
+            if action == 'create':
+                creates.append(validate_question(operation, categories))
+                continue
+
+            question_id = operation.get('id')
+            if not isinstance(question_id, int) or \
+                    isinstance(question_id, bool):
+                raise ValueError('id must be an integer')
+            if action == 'delete':
+                deletes.append(question_id)
+                continue
+
+            changes = validate_question(operation, categories, partial=True)
+            if not changes:
+                raise ValueError('nothing to update')
+            changes['b_id'] = question_id
+            updates.append(changes)
+
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+
+    return creates, updates, deletes, errors
+
+
+def create_questions(rows, counts):
+    '''
+    inserts validated rows, one multi-row INSERT ... RETURNING per batch
+    on PostgreSQL; returns the new ids
+    '''
+    for row in rows:
+        counts[row['b_category']] += 1
+
+    if db.engine.dialect.name != 'postgresql':
+        statement = insert_statement()
+        return [db.session.execute(statement, row).inserted_primary_key[0]
+                for row in rows]
+
+    ids = []
+    for batch in chunks(rows, BATCH_SIZE):
+        ids.extend(question_id for (question_id,) in db.session.execute(
+            Question.__table__.insert().values([{
+                'question': row['b_question'],
+                'answer': row['b_answer'],
+                'category': row['b_category'],
+                'difficulty': row['b_difficulty'],
+                'search_vector': search_vector(row['b_question'],
+                                               row['b_answer'])
+            } for row in batch]).returning(Question.id)))
+
+    return ids
+
+
+def update_questions(updates, counts):
+    '''
+    applies the updates with one executemany per set of changed fields;
+    returns the ids of the questions that do not exist
+    '''
+    ids = list(dict.fromkeys(update['b_id'] for update in updates))
+    categories = {}
+    for batch in chunks(ids, ID_BATCH_SIZE):
+        categories.update(db.session.execute(
+            select([Question.id, Question.category]).
+            where(Question.id.in_(batch))).fetchall())
+    missing = [question_id for question_id in ids
+               if question_id not in categories]
+    if missing:
+        return missing
+
+    groups = {}
+    for update in updates:
+        groups.setdefault(tuple(sorted(update)), []).append(update)
+        category = update.get('b_category')
+        if category is not None and \
+                category != categories[update['b_id']]:
+            counts[categories[update['b_id']]] -= 1
+            counts[category] += 1
+            categories[update['b_id']] = category
+
+    for keys, group in groups.items():
+        values = {field: bindparam('b_' + field) for field in QUESTION_FIELDS
+                  if 'b_' + field in keys}
+        if db.engine.dialect.name == 'postgresql':
+            values['search_vector'] = search_vector(
+                values.get('question', Question.question),
+                values.get('answer', Question.answer))
+        db.session.execute(Question.__table__.update().
+                           where(Question.id == bindparam('b_id')).
+                           values(**values), group)
+
+    return []
+
+
+def delete_questions(ids, counts):
+    '''
+    deletes the questions with one DELETE ... WHERE id IN (...) per batch,
+    RETURNING the deleted rows on PostgreSQL; returns their (id, category)
+    '''
+    deleted = []
+    for batch in chunks(list(dict.fromkeys(ids)), ID_BATCH_SIZE):
+        condition = Question.id.in_(batch)
+        statement = Question.__table__.delete().where(condition)
+        if db.engine.dialect.name == 'postgresql':
+            deleted.extend(db.session.execute(
+                statement.returning(Question.id, Question.category)))
+        else:
+            deleted.extend(db.session.execute(
+                select([Question.id, Question.category]).where(condition)))
+            db.session.execute(statement)
+
+    for row in deleted:
+        counts[row.category] -= 1
+
+    return deleted
+
+
+def apply_operations(operations):
+    '''
+    applies a list of create, update and delete operations as one unit of
+    work: creates, then updates, then deletes, in a single transaction
+    with a single commit. Returns the created, updated and deleted ids,
+    or the errors of the operations when none was applied. Deleting a
+    question that does not exist is not an error, it is left out of the
+    deleted ids.
+    '''
+    creates, updates, deletes, errors = read_operations(
+        operations, Category.categories_map())
+    if errors:
+        return None, errors
+
+    counts = Counter()
+    try:
+        created = create_questions(creates, counts)
+        missing = update_questions(updates, counts) if updates else []
+        if missing:
+            db.session.rollback()
+            return None, [{'index': index,
+                           'error': 'question {} not found'.format(
+                               operation['id'])}
+                          for index, operation in enumerate(operations)
+                          if operation.get('op') == 'update' and
+                          operation['id'] in missing]
+        deleted = delete_questions(deletes, counts)
+
+        for category, delta in counts.items():
+            if delta:
+                Category.adjust_count(category, delta)
+        if created or updates or deleted:
+            Version.bump('questions')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    Question.version_cache().invalidate()
+    if created or updates:
+        notify_question_change('bulk', None)
+    for row in deleted:
+        notify_question_change('delete', row)
+
+    return {
+        'created': created,
+        'updated': list(dict.fromkeys(update['b_id'] for update in updates)),
+        'deleted': [row.id for row in deleted]
+    }, []
@@ -0,0 +1,298 @@
+import csv
+import io
+import json
+import re
+from collections import Counter
+
+from sqlalchemy import bindparam
+
+from models import db, Question, Category, Version, search_vector, \
+    notify_question_change
+from .encoding import iter_json_array
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+# column order of the questions COPY block in trivia.psql
+COPY_COLUMNS = ('id', 'question', 'answer', 'difficulty', 'category')
+EXPORT_COLUMNS = ('id', 'question', 'answer', 'category', 'difficulty')
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+COPY_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+COPY_PATTERN = re.compile(r'COPY public\.(\w+) \((.*)\) FROM stdin;')
+
+
+class BulkImportError(Exception):
+    '''
+    import stopped by an error after committing `inserted` questions
+    '''
+
+    def __init__(self, message, inserted, rejected, errors):
+        Exception.__init__(self, message)
+        self.inserted = inserted
+        self.rejected = rejected
+        self.errors = errors
+
+
+def iter_lines(stream):
+    '''
+    decoded lines of a binary stream, read one at a time. Invalid UTF-8
+    bytes are kept as lone surrogates, for validate_question to reject
+    their row instead of failing the whole stream.
+    '''
+    for line in iter(stream.readline, b''):
+        yield line.decode('utf-8', 'surrogateescape').rstrip('\r\n')
+
+
+def iter_chunk_lines(chunks):
+    '''
+    decoded lines of binary chunks split anywhere, such as those of an
+    Upload, as iter_lines decodes them
+    '''
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'surrogateescape').rstrip('\r')
+    if rest:
+        yield rest.decode('utf-8', 'surrogateescape').rstrip('\r')
+
+
+def read_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, None, 'invalid JSON'
+            continue
+        if isinstance(record, dict):
+            yield number, record, None
+        else:
+            yield number, None, 'expected a JSON object'
+
+
+def read_csv(lines):
+    reader = csv.DictReader(lines)
+    for record in reader:
+        # line of the record's last physical line, the header is line 1
+        yield reader.line_num, record, None
+
+
+def unescape_copy(value):
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+
+    chars, escaped = [], False
+    for char in value:
+        if escaped:
+            chars.append(COPY_ESCAPES.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+
+    return ''.join(chars)
+
+
+def read_copy(lines, columns=COPY_COLUMNS):
+    '''
+    rows in PostgreSQL's COPY text format, as in trivia.psql
+    '''
+    for number, line in enumerate(lines, 1):
+        if line == '\\.':
+            break
+        if not line:
+            continue
+        values = line.split('\t')
+        if len(values) != len(columns):
+            yield number, None, 'expected {} columns'.format(len(columns))
+            continue
+        yield number, dict(zip(columns, map(unescape_copy, values))), None
+
+
+def read_dump(path):
+    '''
+    yields the table name and rows of every COPY block of a pg_dump file
+    such as trivia.psql
+    '''
+    with open(path) as dump:
+        lines = iter(dump.read().splitlines())
+
+    for line in lines:
+        match = COPY_PATTERN.match(line)
+        if match:
+            columns = [column.strip() for column in match.group(2).split(',')]
+            yield match.group(1), [record for (number, record, error)
+                                   in read_copy(lines, columns)]
+
+
+READERS = {
+    'ndjson': read_ndjson,
+    'csv': read_csv,
+    'copy': read_copy,
+}
+
+CONTENT_TYPES = {
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'text/csv': 'csv',
+    'text/tab-separated-values': 'copy',
+}
+
+
+def validate_question(record, categories, partial=False):
+    '''
+    insert parameters of an imported record, raises ValueError when the
+    record is not a valid question. A partial record (an update) only
+    holds the fields it changes.
+    '''
+    params = {}
+    for field in ('question', 'answer'):
+        if partial and field not in record:
+            continue
+        value = record.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('{} is required'.format(field))
+        try:
+            value.encode('utf-8')
+        except UnicodeEncodeError:
+            raise ValueError('{} is not valid UTF-8'.format(field))
+        params['b_' + field] = value
+
+    for field in ('category', 'difficulty'):
+        if partial and field not in record:
+            continue
+        try:
+            params['b_' + field] = int(record.get(field))
+        except (TypeError, ValueError):
+            raise ValueError('category and difficulty must be integers')
+    if 'b_category' in params and params['b_category'] not in categories:
+        raise ValueError('unknown category {}'.format(params['b_category']))
+    if 'b_difficulty' in params and not 1 <= params['b_difficulty'] <= 5:
+        raise ValueError('difficulty must be between 1 and 5')
+
+    return params
+
+
+def insert_statement():
+    values = {
+        'question': bindparam('b_question'),
+        'answer': bindparam('b_answer'),
+        'category': bindparam('b_category'),
+        'difficulty': bindparam('b_difficulty')
+    }
+    if db.engine.dialect.name == 'postgresql':
+        values['search_vector'] = search_vector(bindparam('b_question'),
+                                                bindparam('b_answer'))
+
+    return Question.__table__.insert().values(**values)
+
+
+def insert_batch(statement, batch):
+    '''
+    inserts validated rows and their category counts in one transaction
+    '''
+    db.session.execute(statement, batch)
+    counts = Counter(row['b_category'] for row in batch)
+    for category, count in counts.items():
+        Category.adjust_count(category, count)
+    Version.bump('questions')
+    db.session.commit()
+    Question.version_cache().invalidate()
+
+
+def import_questions(records, batch_size=BATCH_SIZE, progress=None):
+    '''
+    validates and inserts (line, record, error) tuples in batches, one
+    executemany and one commit per batch, calling progress with the rows
+    read so far after each one; returns the number of inserted questions,
+    the number of rejected rows and the first rejections. Raises a
+    BulkImportError holding those counts when a batch or the stream
+    fails, the batches before it staying committed.
+    '''
+    categories = Category.categories_map()
+    statement = insert_statement()
+    inserted, rejected, errors = 0, 0, []
+
+    def reject(number, error):
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'line': number, 'error': error})
+
+    batch = []
+    try:
+        for number, record, error in records:
+            if error is None:
+                try:
+                    batch.append(validate_question(record, categories))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                rejected += 1
+                reject(number, error)
+
+            if len(batch) >= batch_size:
+                insert_batch(statement, batch)
+                inserted += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(inserted + rejected)
+
+        if batch:
+            insert_batch(statement, batch)
+            inserted += len(batch)
+    except Exception as e:
+        db.session.rollback()
+        raise BulkImportError(
+            'import stopped after {} questions: {}'.format(inserted, e),
+            inserted, rejected, errors) from e
+    finally:
+        if inserted:
+            notify_question_change('bulk', None)
+
+    return inserted, rejected, errors
+
+
+def export_questions(export_format, batch_size=BATCH_SIZE):
+    '''
+    yields the questions table as NDJSON, CSV or JSON array chunks, read
+    from a server-side cursor where the driver supports it
+    '''
+    rows = db.session.query(*[getattr(Question, column)
+                              for column in EXPORT_COLUMNS]).\
+        order_by(Question.id).\
+        execution_options(stream_results=True).\
+        yield_per(batch_size)
+
+    if export_format == 'json':
+        yield from iter_json_array((dict(zip(EXPORT_COLUMNS, row))
+                                    for row in rows), batch_size)
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == 'csv':
+        writer.writerow(EXPORT_COLUMNS)
+
+    for number, row in enumerate(rows, 1):
+        if export_format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, row))))
+            buffer.write('\n')
+
+        if number % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
@@ -0,0 +1,86 @@
+import calendar
+import hashlib
+from functools import wraps
+
+from flask import current_app, request
+
+from models import Question, Category
+
+
+def dataset_etag():
+    '''
+    strong ETag of a read response, derived from the questions and
+    categories versions and the request path and query string
+    '''
+    key = '{}:{}:{}'.format(Question.dataset_version(),
+                            Category.cache().version(),
+                            request.full_path)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def dataset_modified():
+    '''
+    Last-Modified date of a read response, in whole seconds since the
+    epoch: the last recorded bump of the questions or categories version,
+    None before any. Bumps are recorded since migration 004, so a recorded
+    one is always later than those that were not.
+    '''
+    modified = [modified for modified in (Question.version_cache().modified(),
+                                          Category.cache().modified())
+                if modified is not None]
+
+    return int(max(modified)) if modified else None
+
+
+def not_modified(etag, modified):
+    '''
+    whether the conditional headers of the request match, If-None-Match
+    taking precedence over If-Modified-Since
+    '''
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is None or modified is None:
+        return False
+
+    return modified <= calendar.timegm(since.utctimetuple())
+
+
+def conditional(view):
+    '''
+    answers If-None-Match and If-Modified-Since with 304 when the dataset
+    did not change, and tags successful responses with an ETag, a
+    Last-Modified and a Cache-Control header.
+    With a response cache, successful bodies are stored under their ETag
+    and served without running the view again.
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = dataset_etag()
+        modified = dataset_modified()
+        cache_control = 'public, max-age={}'.format(
+            current_app.config.get('HTTP_CACHE_MAX_AGE', 10))
+        cache = current_app.extensions.get('response_cache')
+
+        if not_modified(etag, modified):
+            response = current_app.response_class(status=304)
+        else:
+            body = cache.get(etag) if cache is not None else None
+            if body is not None:
+                response = current_app.response_class(
+                    body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if cache is not None:
+                    cache.set(etag, response.get_data())
+
+        response.set_etag(etag)
+        if modified is not None:
+            response.last_modified = modified
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    return wrapper
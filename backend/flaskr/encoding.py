@@ -0,0 +1,90 @@
+import json
+import time
+
+from flask import current_app, g, jsonify
+
+from models import Question
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# fields of Question.format(), in the key order of jsonify's sort_keys
+QUESTION_FIELDS = ('answer', 'category', 'difficulty', 'id', 'question')
+QUESTION_COLUMNS = [getattr(Question, field) for field in QUESTION_FIELDS]
+
+
+def question_dicts(rows):
+    '''
+    Question.format() dictionaries of QUESTION_COLUMNS tuples
+    '''
+    return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+def string_keys(mapping):
+    '''
+    copy of an integer keyed dictionary with the string keys, and the
+    order, of its sorted JSON encoding
+    '''
+    return {str(key): value for key, value in sorted(mapping.items())}
+
+
+def dumps(payload):
+    '''
+    the bytes of jsonify(payload), with orjson when it is installed. The
+    keys of the nested dictionaries must already be strings in sorted
+    order, as built by question_dicts and string_keys.
+    '''
+    payload = {key: payload[key] for key in sorted(payload)}
+    if orjson is not None:
+        body = orjson.dumps(payload)
+        # jsonify escapes everything outside of printable ASCII
+        if body.isascii() and b'\x7f' not in body:
+            return body + b'\n'
+
+    return (json.dumps(payload, separators=(',', ':')) + '\n').encode()
+
+
+def lean_encoding():
+    config = current_app.config
+    return config['JSON_SORT_KEYS'] and config['JSON_AS_ASCII'] and not \
+        (config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug)
+
+
+def json_response(payload):
+    '''
+    response of a payload encoded by dumps, or by jsonify when the app
+    is configured for another output
+    '''
+    if not lean_encoding():
+        return jsonify(payload)
+
+    started = time.perf_counter()
+    body = dumps(payload)
+    metrics = g.get('instrumentation')
+    if metrics is not None:
+        metrics['serialization'] += time.perf_counter() - started
+
+    return current_app.response_class(
+        body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def iter_json_array(dictionaries, batch_size=1000):
+    '''
+    yields a JSON array of already ordered dictionaries in chunks of
+    batch_size items
+    '''
+    encode = orjson.dumps if orjson is not None else \
+        lambda item: json.dumps(item, separators=(',', ':')).encode()
+
+    chunk = [b'[']
+    for number, item in enumerate(dictionaries):
+        if number:
+            chunk.append(b',')
+        chunk.append(encode(item))
+        if len(chunk) >= 2 * batch_size:
+            yield b''.join(chunk)
+            chunk = []
+    chunk.append(b']\n')
+    yield b''.join(chunk)
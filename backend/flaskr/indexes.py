@@ -0,0 +1,88 @@
+import threading
+
+from models import db, Question, on_question_change
+
+
+class VersionedIndex:
+    '''
+    VersionedIndex
+    in-memory index of the questions, one per worker. Built lazily, kept
+    in sync by the question listeners and rebuilt when the dataset version
+    moves past the writes applied to it, as after the writes of other
+    workers or a bulk import. Subclasses empty the index in `reset`, fill
+    it from `rows()` in `load` and apply one question write in `update`.
+    '''
+
+    def __init__(self):
+        self._version = None
+        self._built = False
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        raise NotImplementedError
+
+    def rows(self):
+        raise NotImplementedError
+
+    def load(self, rows):
+        raise NotImplementedError
+
+    def update(self, action, question):
+        raise NotImplementedError
+
+    def build(self, rows=None, version=None):
+        '''
+        fills the index with rows, by default those of the questions table
+        '''
+        with self._lock:
+            self.reset()
+            self.load(self.rows() if rows is None else rows)
+            self._version = version
+            self._built = True
+
+    def current(self):
+        '''
+        the index, rebuilt first if the questions changed since
+        '''
+        version = Question.dataset_version()
+        with self._lock:
+            if not self._built or version != self._version:
+                self.build(version=version)
+
+        return self
+
+    def apply(self, action, question):
+        with self._lock:
+            if not self._built:
+                return
+            if action == 'bulk':
+                # rebuilt on the next use
+                self._built = False
+                return
+            self.update(action, question)
+
+            # only this write moved the version, no need to rebuild
+            version = Question.dataset_version()
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+
+
+def app_extension(name, factory):
+    '''
+    extension `name` of the current application, created by factory on
+    first use
+    '''
+    extensions = db.get_app().extensions
+    extension = extensions.get(name)
+    if extension is None:
+        extension = extensions.setdefault(name, factory())
+
+    return extension
+
+
+@on_question_change
+def sync_indexes(action, question):
+    for extension in list(db.get_app().extensions.values()):
+        if isinstance(extension, VersionedIndex):
+            extension.apply(action, question)
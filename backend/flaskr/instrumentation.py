@@ -0,0 +1,225 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+
+from flask import g, request, has_app_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import config_setting
+
+# upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class RouteMetrics:
+    '''
+    accumulated timings of one route, method and status
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_duration = 0.0
+        self.serialization = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+
+    def add(self, duration, queries, db_duration, serialization):
+        self.requests += 1
+        self.duration += duration
+        self.queries += queries
+        self.db_duration += db_duration
+        self.serialization += serialization
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.buckets[index] += 1
+
+
+class Instrumentation:
+    '''
+    per-request query count, database time, serialization time and total
+    time, reported in Server-Timing headers and in Prometheus text format.
+    With a profile threshold every request is profiled and the cProfile
+    stats of the slower ones are kept (and written to `profile_dir`).
+    '''
+
+    def __init__(self, profile_threshold=None, profile_dir=None,
+                 max_profiles=20):
+        self.profile_threshold = profile_threshold
+        self.profile_dir = profile_dir
+        self.routes = defaultdict(RouteMetrics)
+        self.slow_profiles = deque(maxlen=max_profiles)
+        self._lock = threading.Lock()
+
+    def start(self):
+        g.instrumentation = {
+            'started': time.perf_counter(),
+            'queries': 0,
+            'db_duration': 0.0,
+            'serialization': 0.0,
+            'profile': None
+        }
+        if self.profile_threshold is not None:
+            g.instrumentation['profile'] = cProfile.Profile()
+            g.instrumentation['profile'].enable()
+
+    def finish(self, response):
+        metrics = g.pop('instrumentation', None)
+        if metrics is None:
+            return response
+
+        duration = time.perf_counter() - metrics['started']
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        key = (route, request.method, response.status_code)
+        with self._lock:
+            self.routes[key].add(duration, metrics['queries'],
+                                 metrics['db_duration'],
+                                 metrics['serialization'])
+
+        profile = metrics['profile']
+        if profile is not None:
+            profile.disable()
+            if duration * 1000 >= self.profile_threshold:
+                self.keep_profile(route, duration, profile)
+
+        response.headers.add('Server-Timing', ', '.join([
+            'db;dur={:.2f};desc="{} queries"'.format(
+                metrics['db_duration'] * 1000, metrics['queries']),
+            'serialize;dur={:.2f}'.format(metrics['serialization'] * 1000),
+            'total;dur={:.2f}'.format(duration * 1000)
+        ]))
+        return response
+
+    def keep_profile(self, route, duration, profile):
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats(
+            'cumulative').print_stats(30)
+        self.slow_profiles.append({
+            'route': route,
+            'duration_ms': duration * 1000,
+            'stats': output.getvalue()
+        })
+        if self.profile_dir:
+            name = '{}-{}.prof'.format(
+                route.strip('/').replace('/', '_') or 'root',
+                int(time.time() * 1000))
+            profile.dump_stats(os.path.join(self.profile_dir, name))
+
+    def prometheus(self):
+        '''
+        metrics in the Prometheus text exposition format
+        '''
+        with self._lock:
+            routes = sorted(self.routes.items())
+
+        lines = []
+
+        def family(name, kind, description, values):
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(values)
+
+        def labels(key, **extra):
+            route, method, status = key
+            pairs = [('route', route), ('method', method),
+                     ('status', status)] + sorted(extra.items())
+            return '{' + ','.join('{}="{}"'.format(name, value)
+                                  for name, value in pairs) + '}'
+
+        histogram = []
+        for key, metrics in routes:
+            for bound, count in zip(DURATION_BUCKETS, metrics.buckets):
+                histogram.append('trivia_request_duration_seconds_bucket{} {}'
+                                 .format(labels(key, le=bound), count))
+            histogram.append('trivia_request_duration_seconds_bucket{} {}'
+                             .format(labels(key, le='+Inf'),
+                                     metrics.requests))
+            histogram.append('trivia_request_duration_seconds_sum{} {}'
+                             .format(labels(key), metrics.duration))
+            histogram.append('trivia_request_duration_seconds_count{} {}'
+                             .format(labels(key), metrics.requests))
+        family('trivia_request_duration_seconds', 'histogram',
+               'Request duration by route.', histogram)
+
+        for name, attribute, description in (
+                ('trivia_db_queries_total', 'queries',
+                 'SQL statements executed by route.'),
+                ('trivia_db_duration_seconds_total', 'db_duration',
+                 'Time spent running SQL statements by route.'),
+                ('trivia_serialization_seconds_total', 'serialization',
+                 'Time spent encoding JSON responses by route.')):
+            family(name, 'counter', description, [
+                '{}{} {}'.format(name, labels(key),
+                                 getattr(metrics, attribute))
+                for key, metrics in routes])
+
+        return '\n'.join(lines) + '\n'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # kept on the execution context, which is dropped with it when the
+    # statement fails and after_cursor_execute never runs
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = getattr(context, 'query_started', None)
+    if started is None:
+        return
+    metrics = g.get('instrumentation') if has_app_context() else None
+    if metrics is not None:
+        metrics['queries'] += 1
+        metrics['db_duration'] += time.perf_counter() - started
+
+
+def timed_encoder(encoder):
+    '''
+    JSON encoder class adding its encoding time to the current request
+    '''
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            started = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                metrics = g.get('instrumentation') \
+                    if has_app_context() else None
+                if metrics is not None:
+                    metrics['serialization'] += time.perf_counter() - started
+
+    return TimedJSONEncoder
+
+
+def init_instrumentation(app):
+    '''
+    instruments every request of the app and adds the /metrics endpoint
+    '''
+    instrumentation = Instrumentation(
+        profile_threshold=config_setting(app, 'PROFILE_THRESHOLD_MS',
+                                         type=float),
+        profile_dir=config_setting(app, 'PROFILE_DIR'))
+    app.extensions['instrumentation'] = instrumentation
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    app.json_encoder = timed_encoder(app.json_encoder)
+    app.before_request(instrumentation.start)
+    app.after_request(instrumentation.finish)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(instrumentation.prometheus(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return instrumentation
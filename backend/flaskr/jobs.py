@@ -0,0 +1,336 @@
+import json
+import threading
+import time
+
+from sqlalchemy import and_, or_, func
+
+from models import db, config_setting, search_vector, \
+    notify_question_change, Question, Category, Version, Job, Upload
+from .bulk import BATCH_SIZE, READERS, import_questions, iter_chunk_lines
+from .quiz import quiz_index, quiz_pools
+from .search import search_backend, suggestion_index, InvertedIndex
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed')
+# jobs that can be queued by name, from the API or the command line, and
+# the positive integer arguments each one takes
+MAINTENANCE_JOBS = {
+    'reconcile_counts': (),
+    'refresh_search_vectors': ('batch_size',),
+    'rebuild_indexes': ()
+}
+JOBS = {}
+
+
+def job(kind):
+    '''
+    registers a job function, called with a JobRun and the keyword
+    arguments of the job; its return value is the JSON result of the job
+    '''
+    def register(function):
+        JOBS[kind] = function
+        return function
+
+    return register
+
+
+class JobRun:
+    '''
+    JobRun
+    handle of a running job: reports its progress and, between two
+    batches, yields to the request threads
+    '''
+
+    def __init__(self, job_id, pause=0.0):
+        self.job_id = job_id
+        self.pause = pause
+
+    def progress(self, done, total=None):
+        values = {Job.progress: done, Job.updated_at: time.time()}
+        if total is not None:
+            values[Job.total] = total
+        Job.query.filter(Job.id == self.job_id).update(
+            values, synchronize_session=False)
+        db.session.commit()
+        time.sleep(self.pause)
+
+
+def valid_job_arguments(kind, arguments):
+    '''
+    whether the arguments dictionary only holds arguments the maintenance
+    job `kind` takes, with positive integer values
+    '''
+    return all(name in MAINTENANCE_JOBS[kind] and
+               isinstance(value, int) and not isinstance(value, bool) and
+               value > 0
+               for name, value in arguments.items())
+
+
+def submit_job(kind, arguments=None):
+    '''
+    queues a job and wakes up the job workers of this process, if any
+    '''
+    if kind not in JOBS:
+        raise ValueError('unknown job {}'.format(kind))
+
+    new_job = Job(kind, arguments)
+    db.session.add(new_job)
+    db.session.commit()
+
+    runner = db.get_app().extensions.get('job_runner')
+    if runner is not None:
+        runner.wake()
+
+    return new_job
+
+
+def claim_job(stale_after):
+    '''
+    id of the oldest queued job, or of a running job whose worker stopped
+    reporting for stale_after seconds, now marked running by this worker;
+    None when there is no such job
+    '''
+    now = time.time()
+    claimable = or_(Job.status == 'queued',
+                    and_(Job.status == 'running',
+                         Job.updated_at < now - stale_after))
+    candidates = db.session.query(Job.id).filter(claimable).\
+        order_by(Job.id).limit(10).all()
+
+    for (job_id,) in candidates:
+        # only one worker updates the row while it is still claimable
+        claimed = Job.query.filter(Job.id == job_id, claimable).update({
+            Job.status: 'running',
+            Job.attempts: Job.attempts + 1,
+            Job.started_at: now,
+            Job.updated_at: now
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id
+
+    return None
+
+
+def run_job(job_id, pause=0.0):
+    '''
+    runs a claimed job and records its result, or its error
+    '''
+    claimed = Job.query.get(job_id)
+    kind, arguments = claimed.kind, json.loads(claimed.arguments or '{}')
+    db.session.commit()
+
+    values = {}
+    try:
+        result = JOBS[kind](JobRun(job_id, pause), **arguments)
+        values = {Job.status: 'succeeded', Job.result: json.dumps(result)}
+    except Exception as e:
+        db.session.rollback()
+        values = {Job.status: 'failed',
+                  Job.error: '{}: {}'.format(type(e).__name__, e)}
+
+    now = time.time()
+    values.update({Job.finished_at: now, Job.updated_at: now})
+    Job.query.filter(Job.id == job_id).update(values,
+                                              synchronize_session=False)
+    db.session.commit()
+
+
+def run_pending(pause=0.0, stale_after=600, limit=None):
+    '''
+    runs the claimable jobs one after the other until there is none left,
+    or limit of them ran; returns the number of jobs run
+    '''
+    count = 0
+    while limit is None or count < limit:
+        job_id = claim_job(stale_after)
+        if job_id is None:
+            break
+        run_job(job_id, pause)
+        count += 1
+
+    return count
+
+
+class JobRunner:
+    '''
+    JobRunner
+    pool of worker threads running the queued jobs of the database in the
+    background of the app. The jobs commit after every batch and sleep
+    `pause` seconds, so the request threads keep getting the connections
+    and the interpreter.
+    '''
+
+    def __init__(self, app, workers=1, poll_interval=5.0, pause=0.01,
+                 stale_after=600):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.pause = pause
+        self.stale_after = stale_after
+        self._wake_up = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.work,
+                                      name='trivia-job-{}'.format(number),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wake_up.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self):
+        self._wake_up.set()
+
+    def work(self):
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                self._wake_up.clear()
+                try:
+                    ran = run_pending(self.pause, self.stale_after, limit=1)
+                except Exception:
+                    # the database may be away for a moment
+                    db.session.rollback()
+                    ran = 0
+                finally:
+                    db.session.remove()
+                if not ran:
+                    self._wake_up.wait(self.poll_interval)
+
+
+def init_job_runner(app):
+    '''
+    starts JOB_WORKERS threads running the queued jobs, if any
+    '''
+    workers = config_setting(app, 'JOB_WORKERS', 0, type=int)
+    if not workers:
+        return None
+
+    runner = app.extensions['job_runner'] = JobRunner(
+        app, workers,
+        poll_interval=config_setting(app, 'JOB_POLL_INTERVAL', 5.0,
+                                     type=float),
+        pause=config_setting(app, 'JOB_BATCH_PAUSE', 0.01, type=float),
+        stale_after=config_setting(app, 'JOB_STALE_AFTER', 600, type=float))
+    runner.start()
+
+    return runner
+
+
+@job('reconcile_counts')
+def reconcile_counts(run):
+    '''
+    recomputes the question count of the categories, one category per
+    transaction
+    '''
+    category_ids = [category_id for (category_id,) in
+                    db.session.query(Category.id).order_by(Category.id)]
+    run.progress(0, len(category_ids))
+
+    for done, category_id in enumerate(category_ids, 1):
+        count = db.session.query(func.count(Question.id)).\
+            filter(Question.category == category_id).as_scalar()
+        Category.query.filter(Category.id == category_id).update(
+            {Category.question_count: count}, synchronize_session=False)
+        db.session.commit()
+        run.progress(done)
+
+    # the counts are part of the questions responses
+    Version.bump('questions')
+    db.session.commit()
+    Question.version_cache().invalidate()
+
+    return {'categories': len(category_ids)}
+
+
+@job('refresh_search_vectors')
+def refresh_search_vectors(run, batch_size=BATCH_SIZE):
+    '''
+    recomputes the search_vector of every question, batch_size questions
+    per transaction in id order; only PostgreSQL has the column
+    '''
+    if db.engine.dialect.name != 'postgresql':
+        return {'updated': 0}
+
+    run.progress(0, Question.query.count())
+    updated, last_id = 0, 0
+    while True:
+        ids = [question_id for (question_id,) in
+               db.session.query(Question.id).filter(Question.id > last_id).
+               order_by(Question.id).limit(batch_size)]
+        if not ids:
+            break
+        db.session.execute(
+            Question.__table__.update().
+            where(Question.id.between(ids[0], ids[-1])).
+            values(search_vector=search_vector(Question.question,
+                                               Question.answer)))
+        db.session.commit()
+        updated, last_id = updated + len(ids), ids[-1]
+        run.progress(updated)
+
+    return {'updated': updated}
+
+
+@job('rebuild_indexes')
+def rebuild_indexes(run):
+    '''
+    bumps the questions version, so the in-memory indexes of every worker
+    are rebuilt on their next use, then builds those of the process
+    running the job
+    '''
+    Version.bump('questions')
+    db.session.commit()
+    Question.version_cache().invalidate()
+    notify_question_change('bulk', None)
+
+    steps = [('quiz_pools', quiz_pools().current),
+             ('quiz_index', quiz_index().current),
+             ('suggestion_index', suggestion_index().current)]
+    backend = search_backend()
+    if isinstance(backend, InvertedIndex):
+        steps.append(('search_index', backend.current))
+    run.progress(0, len(steps))
+
+    timings = {}
+    for done, (name, build) in enumerate(steps, 1):
+        started = time.perf_counter()
+        build()
+        timings[name] = time.perf_counter() - started
+        run.progress(done)
+
+    return timings
+
+
+@job('import_questions')
+def import_question_records(run, import_format, upload=None, columns=None,
+                            data=None):
+    '''
+    bulk import of an uploaded NDJSON, CSV or COPY text, read from the
+    Upload `upload` and deleted once done; jobs queued before uploads were
+    staged carry the text in `data`
+    '''
+    if upload is not None:
+        lines = iter_chunk_lines(Upload.chunks(upload))
+    else:
+        lines = iter(data.splitlines())
+    if import_format == 'copy':
+        records = READERS['copy'](lines, columns)
+    else:
+        records = READERS[import_format](lines)
+
+    try:
+        inserted, rejected, errors = import_questions(records,
+                                                      progress=run.progress)
+    finally:
+        if upload is not None:
+            db.session.rollback()
+            Upload.discard(upload)
+    return {'inserted': inserted, 'rejected': rejected, 'errors': errors}
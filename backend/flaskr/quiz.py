@@ -0,0 +1,369 @@
+import random
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from models import db, Question
+from .indexes import VersionedIndex, app_extension
+
+DIFFICULTIES = (1, 2, 3, 4, 5)
+# answers of the player the adaptive difficulty is computed from
+RECENT_ANSWERS = 5
+# random draws tried in a bucket before scanning it for an unseen question
+PICK_ATTEMPTS = 8
+# questions of a quiz session deck, so a session never copies a whole
+# category
+SESSION_QUESTIONS = 100
+
+
+def pick_unseen(ids, exclude):
+    '''
+    random id of a sorted array that is not in exclude, None when they
+    all are: the positions of the excluded ids are found by bisection,
+    then a random rank among the other ids is mapped to its position
+    '''
+    seen = []
+    for question_id in exclude:
+        position = bisect_left(ids, question_id)
+        if position < len(ids) and ids[position] == question_id:
+            seen.append(position)
+    if len(seen) == len(ids):
+        return None
+
+    position = random.randrange(len(ids) - len(seen))
+    for excluded in sorted(seen):
+        if excluded > position:
+            break
+        position += 1
+
+    return ids[position]
+
+
+class QuizPools(VersionedIndex):
+    '''
+    sorted arrays of question ids by category, category 0 holding every
+    question, so a quiz pick draws an unseen id among machine integers
+    instead of querying the category
+    '''
+
+    def __len__(self):
+        return len(self._pools.get(0, ()))
+
+    def reset(self):
+        self._pools = {0: array('i')}
+
+    def rows(self):
+        return db.session.query(Question.id, Question.category).\
+            order_by(Question.id)
+
+    def load(self, rows):
+        # (id, category) rows in id order
+        pools = self._pools
+        for question_id, category in rows:
+            pools[0].append(question_id)
+            if category is not None:
+                pool = pools.get(category)
+                if pool is None:
+                    pool = pools[category] = array('i')
+                pool.append(question_id)
+
+    def nbytes(self):
+        '''
+        bytes held by the id buffers
+        '''
+        with self._lock:
+            return sum(pool.buffer_info()[1] * pool.itemsize
+                       for pool in self._pools.values())
+
+    def ids(self, category):
+        with self._lock:
+            return array('i', self._pools.get(category, ()))
+
+    def sample(self, category, size):
+        '''
+        array of up to size distinct random ids of a category, in random
+        order, drawn without copying the pool
+        '''
+        with self._lock:
+            pool = self._pools.get(category, ())
+            return array('i', random.sample(pool, min(size, len(pool))))
+
+    def add(self, question_id, category):
+        with self._lock:
+            for key in (0, category):
+                if key is None:
+                    continue
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = array('i')
+                position = bisect_left(pool, question_id)
+                if position == len(pool) or pool[position] != question_id:
+                    pool.insert(position, question_id)
+
+    def discard(self, question_id):
+        with self._lock:
+            # the category may have changed since, look everywhere
+            for pool in self._pools.values():
+                position = bisect_left(pool, question_id)
+                if position < len(pool) and pool[position] == question_id:
+                    del pool[position]
+
+    def update(self, action, question):
+        self.discard(question.id)
+        if action != 'delete':
+            self.add(question.id, question.category)
+
+    def pick(self, category, exclude=()):
+        '''
+        random question id of a category not in exclude, a set
+        '''
+        with self._lock:
+            pool = self._pools.get(category)
+            if not pool:
+                return None
+            for _ in range(PICK_ATTEMPTS):
+                question_id = pool[random.randrange(len(pool))]
+                if question_id not in exclude:
+                    return question_id
+
+            # most of the pool was already asked
+            return pick_unseen(pool, exclude)
+
+
+def quiz_pools():
+    '''
+    quiz pools of the current application
+    '''
+    return app_extension('quiz_pools', QuizPools)
+
+
+def select_random_question(category, previous_questions):
+    '''
+    picks one random question, not in previous_questions, from the quiz
+    pools, then fetches it by primary key. Returns None once the pool is
+    used up.
+    '''
+    pools = quiz_pools().current()
+    exclude = set(int(question_id) for question_id in previous_questions)
+
+    while True:
+        question_id = pools.pick(category, exclude)
+        if question_id is None:
+            return None
+        question = Question.query.get(question_id)
+        if question is not None:
+            return question
+        # deleted by another worker, not seen in the version yet
+        pools.discard(question_id)
+
+
+def draw_deck(category, size=SESSION_QUESTIONS):
+    '''
+    array of up to size random question ids of a category (0 for all of
+    them), in random order
+    '''
+    return quiz_pools().current().sample(category, size)
+
+
+def target_difficulty(recent_answers):
+    '''
+    difficulty matching the share of correct answers among the last
+    RECENT_ANSWERS ones (True for correct), the middle one without any
+    '''
+    recent_answers = recent_answers[-RECENT_ANSWERS:]
+    if not recent_answers:
+        return DIFFICULTIES[len(DIFFICULTIES) // 2]
+
+    correct = sum(1 for answer in recent_answers if answer) / \
+        len(recent_answers)
+    return DIFFICULTIES[int(round(correct * (len(DIFFICULTIES) - 1)))]
+
+
+class Bucket:
+    '''
+    question ids with O(1) add, remove and random pick: a list, and the
+    position of every id in it to swap the removed ones with the last
+    '''
+    __slots__ = ('ids', 'positions')
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, question_id):
+        if question_id not in self.positions:
+            self.positions[question_id] = len(self.ids)
+            self.ids.append(question_id)
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if position < len(self.ids):
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def pick(self, exclude):
+        '''
+        random id not in exclude, None when they are all excluded
+        '''
+        if not self.ids:
+            return None
+        for _ in range(PICK_ATTEMPTS):
+            question_id = self.ids[random.randrange(len(self.ids))]
+            if question_id not in exclude:
+                return question_id
+
+        # most of the bucket was already asked
+        unseen = [question_id for question_id in self.ids
+                  if question_id not in exclude]
+        return random.choice(unseen) if unseen else None
+
+
+class DifficultyIndex(VersionedIndex):
+    '''
+    in-memory question ids bucketed by (category, difficulty), category 0
+    holding every question, so an adaptive quiz pick draws from a bucket
+    in constant time instead of querying the category
+    '''
+
+    def __len__(self):
+        return len(self._keys)
+
+    def reset(self):
+        self._buckets, self._keys = {}, {}
+
+    def rows(self):
+        return db.session.query(Question.id, Question.category,
+                                Question.difficulty)
+
+    def load(self, rows):
+        # (id, category, difficulty) rows
+        for question_id, category, difficulty in rows:
+            self.add(question_id, category, difficulty)
+
+    def add(self, question_id, category, difficulty):
+        with self._lock:
+            self.discard(question_id)
+            difficulty = min(DIFFICULTIES[-1],
+                             max(DIFFICULTIES[0], int(difficulty or 0)))
+            self._keys[question_id] = (category, difficulty)
+            for key in ((category, difficulty), (0, difficulty)):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = Bucket()
+                bucket.add(question_id)
+
+    def discard(self, question_id):
+        with self._lock:
+            key = self._keys.pop(question_id, None)
+            if key is None:
+                return
+            category, difficulty = key
+            for key in ((category, difficulty), (0, difficulty)):
+                self._buckets[key].remove(question_id)
+
+    def update(self, action, question):
+        if action == 'delete':
+            self.discard(question.id)
+        else:
+            self.add(question.id, question.category, question.difficulty)
+
+    def pick(self, category, difficulty, exclude=()):
+        '''
+        random question id of a category not in exclude, of the given
+        difficulty or else of the closest one
+        '''
+        with self._lock:
+            for level in sorted(DIFFICULTIES, key=lambda level: (
+                    abs(level - difficulty), level)):
+                bucket = self._buckets.get((category, level))
+                question_id = bucket.pick(exclude) if bucket else None
+                if question_id is not None:
+                    return question_id
+
+        return None
+
+
+def quiz_index():
+    '''
+    difficulty index of the current application
+    '''
+    return app_extension('quiz_index', DifficultyIndex)
+
+
+def select_adaptive_question(category, previous_questions, recent_answers):
+    '''
+    picks a question, not in previous_questions, at the difficulty the
+    player's recent answers call for, from the difficulty index
+    '''
+    index = quiz_index().current()
+    difficulty = target_difficulty(recent_answers)
+    exclude = set(int(question_id) for question_id in previous_questions)
+
+    while True:
+        question_id = index.pick(category, difficulty, exclude)
+        if question_id is None:
+            return None
+        question = Question.query.get(question_id)
+        if question is not None:
+            return question
+        # deleted by another worker
+        index.discard(question_id)
+
+
+class QuizSessionStore:
+    '''
+    in-memory quiz sessions, each one a shuffled deck of question ids
+    kept in a compact array and evicted after `ttl` idle seconds
+    '''
+
+    def __init__(self, ttl=3600, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, deck):
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._evict(time.monotonic())
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._sessions[session_id] = [deck, time.monotonic() + self.ttl]
+
+        return session_id
+
+    def pop(self, session_id):
+        '''
+        (next question id, questions left) of a session, the id None once
+        its deck is empty; raises KeyError for unknown or expired sessions
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions[session_id]
+            session[1] = now + self.ttl
+            self._sessions.move_to_end(session_id)
+            deck = session[0]
+
+            return (deck.pop() if deck else None), len(deck)
+
+    def _evict(self, now):
+        # sessions are kept in expiry order, the oldest first
+        while self._sessions:
+            session_id, (deck, expires_at) = next(iter(
+                self._sessions.items()))
+            if expires_at > now:
+                break
+            del self._sessions[session_id]
@@ -0,0 +1,148 @@
+import itertools
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import create_engine, event, select
+
+from models import db, config_setting, engine_options, Version
+
+# POST endpoints that only read, served by the replicas like GET requests
+READ_ONLY_ENDPOINTS = ('play_quiz', 'create_quiz_session',
+                       'questions_search', 'create_room', 'join_room',
+                       'next_room_question', 'answer_room_question')
+# cookie keeping the reads of a client on the primary after its writes
+PRIMARY_COOKIE = 'trivia_read_primary_until'
+
+
+class ReplicaRouter:
+    '''
+    picks the replica engine of a read request, by round-robin or by
+    least checked out connections. When lag aware, a replica whose
+    dataset versions are behind the primary's is skipped, and reads fall
+    back to the primary when every replica lags.
+    '''
+
+    def __init__(self, engines, strategy='round-robin', lag_aware=False,
+                 lag_check_interval=1.0):
+        if strategy not in ('round-robin', 'least-connections'):
+            raise ValueError('unknown replica strategy {}'.format(strategy))
+        self.engines = engines
+        self.strategy = strategy
+        self.lag_aware = lag_aware
+        self.lag_check_interval = lag_check_interval
+        self.connections = {engine: 0 for engine in engines}
+        self._cycle = itertools.cycle(engines)
+        self._fresh = list(engines)
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+        for engine in engines:
+            event.listen(engine, 'checkout', self._checkout(engine))
+            event.listen(engine, 'checkin', self._checkin(engine))
+
+    def _checkout(self, engine):
+        def checkout(dbapi_connection, record, proxy):
+            with self._lock:
+                self.connections[engine] += 1
+        return checkout
+
+    def _checkin(self, engine):
+        def checkin(dbapi_connection, record):
+            with self._lock:
+                self.connections[engine] -= 1
+        return checkin
+
+    def fresh_engines(self, primary):
+        '''
+        replicas whose versions match the primary's, re-checked at most
+        every lag_check_interval seconds
+        '''
+        if not self.lag_aware:
+            return self.engines
+
+        now = time.monotonic()
+        if self._checked_at is None or \
+                now - self._checked_at >= self.lag_check_interval:
+            versions = read_versions(primary)
+            fresh = []
+            for engine in self.engines:
+                try:
+                    if read_versions(engine) == versions:
+                        fresh.append(engine)
+                except Exception:
+                    # an unreachable replica is as good as lagging
+                    pass
+            self._fresh, self._checked_at = fresh, now
+
+        return self._fresh
+
+    def engine_for_read(self, primary):
+        '''
+        replica engine for a read request, None to use the primary
+        '''
+        engines = self.fresh_engines(primary)
+        if not engines:
+            return None
+
+        with self._lock:
+            if self.strategy == 'least-connections':
+                return min(engines, key=lambda engine: (
+                    self.connections[engine], self.engines.index(engine)))
+            for engine in self._cycle:
+                if engine in engines:
+                    return engine
+
+
+def read_versions(engine):
+    with engine.connect() as connection:
+        return dict(connection.execute(
+            select([Version.name, Version.value])).fetchall())
+
+
+def read_only_request():
+    return request.method in ('GET', 'HEAD') or \
+        request.endpoint in READ_ONLY_ENDPOINTS
+
+
+def init_read_routing(app):
+    '''
+    routes the reads of read-only requests to the DATABASE_REPLICA_URLS
+    (comma separated), and keeps the reads of a client on the primary
+    for READ_YOUR_WRITES_SECONDS after its own writes
+    '''
+    urls = [url.strip() for url in (config_setting(
+        app, 'DATABASE_REPLICA_URLS') or '').split(',') if url.strip()]
+    if not urls:
+        return None
+
+    router = ReplicaRouter(
+        [create_engine(url, **engine_options(app, url)) for url in urls],
+        strategy=config_setting(app, 'REPLICA_STRATEGY', 'round-robin'),
+        lag_aware=config_setting(app, 'REPLICA_LAG_AWARE', False,
+                                 type=bool),
+        lag_check_interval=config_setting(app, 'REPLICA_LAG_CHECK_INTERVAL',
+                                          1.0, type=float))
+    app.extensions['replica_router'] = router
+    read_your_writes = config_setting(app, 'READ_YOUR_WRITES_SECONDS', 5,
+                                      type=float)
+
+    @app.before_request
+    def choose_read_engine():
+        if not read_only_request():
+            return
+        primary_until = request.cookies.get(PRIMARY_COOKIE, type=float)
+        if primary_until is not None and primary_until > time.time():
+            return
+        g.read_engine = router.engine_for_read(db.get_engine(app))
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and \
+                not read_only_request() and response.status_code < 400:
+            response.set_cookie(PRIMARY_COOKIE,
+                                str(time.time() + read_your_writes),
+                                max_age=int(read_your_writes) + 1)
+        return response
+
+    return router
@@ -0,0 +1,276 @@
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from models import db, config_setting, on_question_change, Question
+
+
+class MemoryCache:
+    '''
+    process local LRU cache of response bodies, capped in bytes
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self.size -= len(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class SQLiteCache:
+    '''
+    LRU cache of response bodies in a SQLite file shared by the workers
+    of a host, capped in bytes and expiring after `ttl` seconds
+    '''
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS response_cache ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+            'size INTEGER NOT NULL, expires REAL NOT NULL, '
+            'accessed REAL NOT NULL)')
+        self.connection().execute(
+            'CREATE INDEX IF NOT EXISTS ix_response_cache_accessed '
+            'ON response_cache (accessed)')
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # autocommit, every statement is its own transaction
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        connection = self.connection()
+        now = time.time()
+        row = connection.execute(
+            'SELECT value FROM response_cache WHERE key = ? AND expires > ?',
+            (key, now)).fetchone()
+        if row is None:
+            return None
+        connection.execute(
+            'UPDATE response_cache SET accessed = ? WHERE key = ?',
+            (now, key))
+        return bytes(row[0])
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        connection = self.connection()
+        now = time.time()
+        connection.execute(
+            'INSERT OR REPLACE INTO response_cache '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, value, len(value), now + self.ttl, now))
+        self._evict(connection, now)
+
+    def _evict(self, connection, now):
+        connection.execute('DELETE FROM response_cache WHERE expires <= ?',
+                           (now,))
+        excess = connection.execute(
+            'SELECT coalesce(sum(size), 0) FROM response_cache'
+        ).fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+
+        keys = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM response_cache ORDER BY accessed'):
+            keys.append(key)
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany('DELETE FROM response_cache WHERE key = ?',
+                               [(key,) for key in keys])
+
+    def clear(self):
+        self.connection().execute('DELETE FROM response_cache')
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisCache:
+    '''
+    response bodies in Redis, or any server speaking its protocol, through
+    a minimal RESP client. Entries expire after `ttl` seconds; the LRU
+    eviction and size cap are the server's maxmemory settings. A server
+    that cannot be reached, or replies with an error, is a cache miss; one
+    that cannot be connected to is skipped for `retry_after` seconds.
+    '''
+
+    def __init__(self, url, ttl, prefix='trivia:response:', timeout=1.0,
+                 retry_after=5.0):
+        url = urlparse(url)
+        self.address = (url.hostname or 'localhost', url.port or 6379)
+        self.password = url.password
+        self.database = int(url.path.strip('/') or 0)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.timeout = timeout
+        self.retry_after = retry_after
+        # shared by the threads, so one failure spares them all the wait
+        self._retry_at = 0
+        self._local = threading.local()
+
+    def connection(self):
+        stream = getattr(self._local, 'stream', None)
+        if stream is None:
+            sock = socket.create_connection(self.address, self.timeout)
+            stream = sock.makefile('rwb')
+            self._local.stream = stream
+            if self.password:
+                self._call(stream, 'AUTH', self.password)
+            if self.database:
+                self._call(stream, 'SELECT', self.database)
+        return stream
+
+    def command(self, *args):
+        if time.monotonic() < self._retry_at:
+            return None
+        connecting = getattr(self._local, 'stream', None) is None
+        try:
+            return self._call(self.connection(), *args)
+        except (OSError, RedisError) as error:
+            # such as -NOAUTH or -OOM, the stream may be left mid-reply
+            stream = getattr(self._local, 'stream', None)
+            self._local.stream = None
+            if stream is not None:
+                stream.close()
+            if connecting or isinstance(error, OSError):
+                # down or refusing us, not worth a timeout per request
+                self._retry_at = time.monotonic() + self.retry_after
+            return None
+
+    def _call(self, stream, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        stream.write(b''.join(parts))
+        stream.flush()
+
+        return self._read(stream)
+
+    def _read(self, stream):
+        line = stream.readline()
+        if not line:
+            raise ConnectionError('connection closed by the server')
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(value.decode('utf-8'))
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if int(value) < 0:
+                return None
+            data = stream.read(int(value) + 2)
+            return data[:-2]
+        if kind == b'*':
+            if int(value) < 0:
+                return None
+            return [self._read(stream) for _ in range(int(value))]
+        raise RedisError('unexpected reply {!r}'.format(line))
+
+    def get(self, key):
+        return self.command('GET', self.prefix + key)
+
+    def set(self, key, value):
+        self.command('SET', self.prefix + key, value, 'EX', self.ttl)
+
+    def clear(self):
+        cursor = '0'
+        while True:
+            reply = self.command('SCAN', cursor, 'MATCH', self.prefix + '*',
+                                 'COUNT', 1000)
+            if reply is None:
+                return
+            cursor, keys = reply[0].decode(), reply[1]
+            if keys:
+                self.command('DEL', *keys)
+            if cursor == '0':
+                return
+
+
+def cache_backend(url, max_bytes, ttl):
+    '''
+    response cache backend of a RESPONSE_CACHE setting: `memory`,
+    `sqlite:///path/to/cache.db` or `redis://host:port/db`
+    '''
+    if url == 'memory':
+        return MemoryCache(max_bytes)
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):], max_bytes, ttl)
+    if url.startswith('redis://'):
+        return RedisCache(url, ttl)
+
+    raise ValueError('unknown response cache {}'.format(url))
+
+
+def init_response_cache(app):
+    '''
+    sets up the response cache of the RESPONSE_CACHE setting, if any
+    '''
+    url = config_setting(app, 'RESPONSE_CACHE')
+    if url:
+        app.extensions['response_cache'] = cache_backend(
+            url,
+            config_setting(app, 'RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024,
+                           type=int),
+            config_setting(app, 'RESPONSE_CACHE_TTL', 300, type=int))
+
+
+@on_question_change
+def clear_response_cache(action, question):
+    # the dataset version in the keys already hides the stale responses,
+    # this frees their space right away, once per committed version: a
+    # batch notifies every question it deleted
+    app = db.get_app()
+    cache = app.extensions.get('response_cache')
+    if cache is None:
+        return
+    version = Question.dataset_version()
+    if app.extensions.get('response_cache_cleared') != version:
+        app.extensions['response_cache_cleared'] = version
+        cache.clear()
@@ -0,0 +1,259 @@
+import json
+import secrets
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from models import Question
+
+# questions of a room when its host does not say
+ROOM_QUESTIONS = 10
+MAX_ROOM_QUESTIONS = 100
+# entries of the leaderboard and of the most given answers in the events
+LEADERBOARD_SIZE = 10
+TOP_ANSWERS = 5
+# comment line sent to idle event streams, so proxies keep them open
+KEEPALIVE = b': keepalive\n\n'
+
+
+def normalize_answer(answer):
+    return ' '.join(str(answer).lower().split())
+
+
+def server_sent_event(event_id, name, data):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event_id, name, json.dumps(data)).encode('utf-8')
+
+
+class RoomError(Exception):
+    '''
+    request a room cannot take in its current state
+    '''
+
+
+class Room:
+    '''
+    Room
+    live quiz where every player gets the same question sequence, drawn
+    once when the room is created. The host moves to the next question,
+    which is read from the database once for the whole room; the answers
+    are tallied in memory. Every change is an event of the room's log,
+    pushed to its subscribers: threads wait on the condition, callbacks
+    (such as asyncio wake-ups) are called on every publish.
+    '''
+
+    def __init__(self, category, sequence):
+        self.id = secrets.token_urlsafe(8)
+        self.host_token = secrets.token_urlsafe(16)
+        self.category = category
+        self.sequence = sequence
+        self.position = 0
+        self.question = None
+        self.players = {}
+        self.scores = Counter()
+        self.answers = {}
+        self.finished = False
+        self.events = []
+        self._condition = threading.Condition()
+        self._subscribers = set()
+
+    def publish(self, name, data):
+        with self._condition:
+            self.events.append((len(self.events) + 1, name, data))
+            self._condition.notify_all()
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback()
+
+    def subscribe(self, callback):
+        with self._condition:
+            self._subscribers.add(callback)
+
+    def unsubscribe(self, callback):
+        with self._condition:
+            self._subscribers.discard(callback)
+
+    def events_after(self, cursor):
+        with self._condition:
+            return self.events[cursor:]
+
+    def wait(self, cursor, timeout):
+        '''
+        events after the cursor, waiting up to timeout seconds for some
+        '''
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.events) > cursor or
+                                     self.finished, timeout)
+            return self.events[cursor:]
+
+    def is_host(self, token):
+        return isinstance(token, str) and \
+            secrets.compare_digest(token, self.host_token)
+
+    def join(self, name):
+        with self._condition:
+            if self.finished:
+                raise RoomError('the quiz is over')
+            player_id = secrets.token_urlsafe(8)
+            self.players[player_id] = name
+            self.scores[player_id] = 0
+
+        return player_id
+
+    def leaderboard(self):
+        with self._condition:
+            return [{'name': self.players[player_id], 'score': score}
+                    for player_id, score in
+                    self.scores.most_common(LEADERBOARD_SIZE)]
+
+    def answer(self, player_id, answer):
+        '''
+        records the answer of a player to the current question, returns
+        whether it is correct
+        '''
+        with self._condition:
+            if player_id not in self.players:
+                raise KeyError(player_id)
+            if self.question is None:
+                raise RoomError('no question is open')
+            if player_id in self.answers:
+                raise RoomError('already answered')
+            answer = normalize_answer(answer)
+            self.answers[player_id] = answer
+            correct = answer == normalize_answer(self.question['answer'])
+            if correct:
+                self.scores[player_id] += 1
+
+        return correct
+
+    def close_question(self):
+        with self._condition:
+            question, self.question = self.question, None
+            answers, self.answers = self.answers, {}
+        if question is None:
+            return
+
+        expected = normalize_answer(question['answer'])
+        self.publish('results', {
+            'number': self.position,
+            'question_id': question['id'],
+            'answer': question['answer'],
+            'answers': len(answers),
+            'correct': sum(1 for answer in answers.values()
+                           if answer == expected),
+            'top_answers': [{'answer': answer, 'count': count}
+                            for answer, count in Counter(
+                                answers.values()).most_common(TOP_ANSWERS)],
+            'leaderboard': self.leaderboard()
+        })
+
+    def next_question(self):
+        '''
+        closes the current question and opens the next one of the
+        sequence, skipping the deleted questions; returns it, or None once
+        the sequence is over
+        '''
+        # the condition's lock is reentrant, a second host request waits
+        with self._condition:
+            if self.finished:
+                raise RoomError('the quiz is over')
+            self.close_question()
+
+            question = None
+            while question is None and self.position < len(self.sequence):
+                question = Question.query.get(self.sequence[self.position])
+                self.position += 1
+
+            if question is None:
+                # the streams that see finished have the event already
+                self.publish('finished', {'leaderboard': self.leaderboard()})
+                self.finished = True
+                return None
+
+            self.question = question.format()
+            self.publish('question', {
+                'number': self.position,
+                'total': len(self.sequence),
+                'question': {key: value for key, value
+                             in self.question.items() if key != 'answer'}
+            })
+
+            return self.question
+
+    def state(self):
+        with self._condition:
+            return {
+                'room_id': self.id,
+                'category': self.category,
+                'players': len(self.players),
+                'total_questions': len(self.sequence),
+                'question_number': self.position,
+                'finished': self.finished,
+                'events': len(self.events)
+            }
+
+
+def room_event_stream(room, cursor=0, keepalive=15):
+    '''
+    Server-Sent Events of a room after the cursor, ending after the
+    finished event. Each stream holds a thread, the ASGI app serves them
+    on its event loop instead.
+    '''
+    while True:
+        events = room.wait(cursor, keepalive)
+        if not events:
+            if room.finished:
+                return
+            yield KEEPALIVE
+            continue
+        for event in events:
+            yield server_sent_event(*event)
+        cursor = events[-1][0]
+
+
+class RoomStore:
+    '''
+    in-memory quiz rooms, evicted after `ttl` idle seconds; their event
+    streams get a keepalive comment after `keepalive` idle seconds
+    '''
+
+    def __init__(self, ttl=3600, keepalive=15, max_rooms=1000):
+        self.ttl = ttl
+        self.keepalive = keepalive
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def create(self, category, sequence):
+        room = Room(category, sequence)
+        with self._lock:
+            self._evict(time.monotonic())
+            while len(self._rooms) >= self.max_rooms:
+                self._rooms.popitem(last=False)
+            self._rooms[room.id] = [room, time.monotonic() + self.ttl]
+
+        return room
+
+    def get(self, room_id):
+        '''
+        a room by id; raises KeyError for unknown or expired rooms
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._rooms[room_id]
+            entry[1] = now + self.ttl
+            self._rooms.move_to_end(room_id)
+
+            return entry[0]
+
+    def _evict(self, now):
+        # rooms are kept in expiry order, the oldest first
+        while self._rooms:
+            room_id, (room, expires_at) = next(iter(self._rooms.items()))
+            if expires_at > now:
+                break
+            del self._rooms[room_id]
@@ -0,0 +1,230 @@
+import bisect
+import heapq
+import re
+
+from sqlalchemy import func
+
+from models import db, Question
+from .encoding import QUESTION_COLUMNS, question_dicts
+from .indexes import VersionedIndex, app_extension
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# suggestions returned by default and at most
+SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
+# prefixes up to this length have their suggestions memoized, longer ones
+# only span a few tokens of the sorted list
+MEMOIZED_PREFIX_LENGTH = 2
+
+# ts_rank default weights of the question ('A') and answer ('B') fields
+QUESTION_WEIGHT = 1.0
+ANSWER_WEIGHT = 0.4
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+def prefix_tsquery(terms, include_answers=False):
+    '''
+    tsquery matching every term as a word prefix of the question, or of
+    the question and the answer
+    '''
+    weights = '' if include_answers else 'A'
+    return func.to_tsquery('simple', ' & '.join(
+        '{}:*{}'.format(term, weights) for term in terms))
+
+
+class PostgresSearch:
+    '''
+    full-text search over the GIN indexed `questions.search_vector`,
+    every term matching as a word prefix, ranked with ts_rank
+    '''
+
+    def search(self, phrase, include_answers=False, offset=0, limit=10):
+        terms = tokenize(phrase)
+        selection = Question.query.with_entities(*QUESTION_COLUMNS)
+
+        if terms:
+            query = prefix_tsquery(terms, include_answers)
+            selection = selection.\
+                filter(Question.search_vector.op('@@')(query)).\
+                order_by(func.ts_rank(Question.search_vector, query).desc(),
+                         Question.id)
+        else:
+            selection = selection.order_by(Question.id)
+
+        total = selection.order_by(None).count()
+        questions = question_dicts(selection.offset(offset).limit(limit))
+
+        return questions, total
+
+
+class InvertedIndex(VersionedIndex):
+    '''
+    pure-Python fallback used when the database is not PostgreSQL, built
+    on the first search; prefix lookups bisect a sorted token list
+    '''
+
+    def reset(self):
+        self._postings, self._documents, self._tokens = {}, {}, []
+
+    def rows(self):
+        return db.session.query(Question.id, Question.question,
+                                Question.answer)
+
+    def load(self, rows):
+        for question_id, question, answer in rows:
+            self._add(question_id, question, answer)
+
+    def update(self, action, question):
+        self._remove(question.id)
+        if action != 'delete':
+            self._add(question.id, question.question, question.answer)
+
+    def search(self, phrase, include_answers=False, offset=0, limit=10):
+        with self._lock:
+            self.current()
+            ranked = self._rank(tokenize(phrase), include_answers)
+
+        page = ranked[offset:offset + limit]
+        questions = {question['id']: question for question in
+                     question_dicts(Question.query.
+                                    with_entities(*QUESTION_COLUMNS).
+                                    filter(Question.id.in_(page)))} \
+            if page else {}
+
+        return [questions[question_id] for question_id in page
+                if question_id in questions], len(ranked)
+
+    def _rank(self, terms, include_answers):
+        if not terms:
+            return sorted(self._documents)
+
+        scores = None
+        for term in terms:
+            matches = {}
+            start = bisect.bisect_left(self._tokens, term)
+            for token in self._tokens[start:]:
+                if not token.startswith(term):
+                    break
+                for question_id, weight in self._postings[token].items():
+                    if include_answers or weight == QUESTION_WEIGHT:
+                        matches[question_id] = max(
+                            weight, matches.get(question_id, 0))
+
+            if scores is None:
+                scores = matches
+            else:
+                scores = {question_id: score + matches[question_id]
+                          for question_id, score in scores.items()
+                          if question_id in matches}
+            if not scores:
+                return []
+
+        return sorted(scores, key=lambda question_id: (-scores[question_id],
+                                                       question_id))
+
+    def _add(self, question_id, question, answer):
+        weights = {token: ANSWER_WEIGHT for token in tokenize(answer)}
+        weights.update({token: QUESTION_WEIGHT
+                        for token in tokenize(question)})
+
+        for token, weight in weights.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                bisect.insort(self._tokens, token)
+            postings[question_id] = weight
+        self._documents[question_id] = set(weights)
+
+    def _remove(self, question_id):
+        for token in self._documents.pop(question_id, ()):
+            postings = self._postings[token]
+            postings.pop(question_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+
+class SuggestionIndex(VersionedIndex):
+    '''
+    type-ahead completions of the last word of a phrase, the words of the
+    questions (never the answers) starting with it, most frequent first.
+    A sorted token list is bisected for the prefix range; the suggestions
+    of the shortest prefixes, whose range is the widest, are memoized.
+    '''
+
+    def reset(self):
+        self._counts, self._documents, self._tokens = {}, {}, []
+        self._memo = {}
+
+    def rows(self):
+        return db.session.query(Question.id, Question.question)
+
+    def load(self, rows):
+        for question_id, question in rows:
+            self._add(question_id, question)
+
+    def update(self, action, question):
+        self._memo = {}
+        self._remove(question.id)
+        if action != 'delete':
+            self._add(question.id, question.question)
+
+    def suggest(self, phrase, limit=SUGGESTIONS):
+        words = tokenize(phrase)
+        if not words or not phrase[-1:].isalnum():
+            # nothing typed, or the last word is already complete
+            return []
+        prefix = words.pop()
+
+        with self._lock:
+            self.current()
+            completions = self._memo.get(prefix)
+            if completions is None or len(completions) < limit:
+                completions = self._complete(prefix, limit)
+                if len(prefix) <= MEMOIZED_PREFIX_LENGTH:
+                    self._memo[prefix] = completions
+
+        return [' '.join(words + [token]) for token in completions[:limit]]
+
+    def _complete(self, prefix, limit):
+        start = bisect.bisect_left(self._tokens, prefix)
+        end = bisect.bisect_left(self._tokens, prefix + '\uffff', start)
+        return heapq.nsmallest(
+            max(limit, SUGGESTIONS), self._tokens[start:end],
+            key=lambda token: (-self._counts[token], token))
+
+    def _add(self, question_id, question):
+        tokens = set(tokenize(question))
+        for token in tokens:
+            count = self._counts.get(token, 0)
+            if count == 0:
+                bisect.insort(self._tokens, token)
+            self._counts[token] = count + 1
+        self._documents[question_id] = tokens
+
+    def _remove(self, question_id):
+        for token in self._documents.pop(question_id, ()):
+            self._counts[token] -= 1
+            if self._counts[token] == 0:
+                del self._counts[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+
+def suggestion_index():
+    '''
+    type-ahead index of the current application
+    '''
+    return app_extension('suggestion_index', SuggestionIndex)
+
+
+def search_backend():
+    '''
+    search backend of the current application, chosen by database dialect
+    '''
+    return app_extension('search_backend', lambda: PostgresSearch()
+                         if db.engine.dialect.name == 'postgresql'
+                         else InvertedIndex())
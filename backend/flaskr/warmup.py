@@ -0,0 +1,49 @@
+import time
+
+from models import db, Question, Category
+from .quiz import quiz_index, quiz_pools
+from .search import search_backend, suggestion_index, InvertedIndex
+
+
+def open_pool_connections():
+    '''
+    checks out as many connections as the pool keeps open, so the
+    first requests do not pay for connecting
+    '''
+    pool = db.engine.pool
+    size = pool.size() if hasattr(pool, 'size') else 1
+    connections = [db.engine.connect() for _ in range(size)]
+    for connection in connections:
+        connection.close()
+
+    return size
+
+
+def warm_up(app):
+    '''
+    pre-opens the pooled connections, loads the cached versions and
+    categories, builds the in-memory indexes and renders the first page
+    of questions; returns the seconds spent on each step
+    '''
+    timings = {}
+
+    def step(name, function):
+        started = time.perf_counter()
+        function()
+        timings[name] = time.perf_counter() - started
+
+    with app.app_context():
+        step('connections', open_pool_connections)
+        step('versions', Question.dataset_version)
+        step('categories', Category.categories_map)
+        backend = search_backend()
+        if isinstance(backend, InvertedIndex):
+            step('search_index', backend.current)
+        step('quiz_pools', quiz_pools().current)
+        step('quiz_index', quiz_index().current)
+        step('suggestion_index', suggestion_index().current)
+
+    # through the whole stack, filling the response cache if there is one
+    step('first_page', lambda: app.test_client().get('/questions'))
+
+    return timings
@@ -0,0 +1,12 @@
+--
+-- Full-text search document of the questions, see models.search_vector
+--
+
+ALTER TABLE public.questions ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+UPDATE public.questions SET search_vector =
+    setweight(to_tsvector('simple', coalesce(question, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(answer, '')), 'B');
+
+CREATE INDEX IF NOT EXISTS ix_questions_search_vector
+    ON public.questions USING gin (search_vector);
@@ -0,0 +1,25 @@
+--
+-- Integer category foreign key of the questions, with the (category, id)
+-- index used by the per-category listings, counts and quiz picks
+--
+
+ALTER TABLE public.questions
+    ALTER COLUMN category TYPE integer USING category::integer;
+
+UPDATE public.questions SET category = NULL
+    WHERE category NOT IN (SELECT id FROM public.categories);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'category') THEN
+        ALTER TABLE ONLY public.questions
+            ADD CONSTRAINT category FOREIGN KEY (category)
+            REFERENCES public.categories(id)
+            ON UPDATE CASCADE ON DELETE SET NULL;
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_id
+    ON public.questions (category, id);
+
+ANALYZE public.questions;
@@ -0,0 +1,11 @@
+--
+-- Materialized question count of every category, maintained by the
+-- Question write methods
+--
+
+ALTER TABLE public.categories
+    ADD COLUMN IF NOT EXISTS question_count integer NOT NULL DEFAULT 0;
+
+UPDATE public.categories SET question_count = (
+    SELECT count(*) FROM public.questions
+    WHERE questions.category = categories.id);
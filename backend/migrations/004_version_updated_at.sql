@@ -0,0 +1,7 @@
+--
+-- Time of the last bump of every dataset version, the Last-Modified date
+-- of the read responses. The table itself is created by `flask init-db`.
+--
+
+ALTER TABLE IF EXISTS public.versions
+    ADD COLUMN IF NOT EXISTS updated_at double precision;
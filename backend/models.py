@@ -1,24 +1,205 @@
+import itertools
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import time
+import uuid
+from sqlalchemy import Column, String, Integer, Float, Text, create_engine, \
+    DDL, event, func, select, ForeignKey, Index, LargeBinary, inspect
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_name = "trivia"
 database_path = "postgres://{}/{}".format('localhost:5432', database_name)
+default_database_path = database_path
 
-db = SQLAlchemy()
+
+class RoutingSession(SignallingSession):
+    '''
+    RoutingSession
+    session sending the reads of a request to the replica engine chosen
+    for it (g.read_engine), and every write and flush to the primary
+    '''
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and not self._flushing and \
+                not isinstance(clause, UpdateBase):
+            engine = g.get('read_engine')
+            if engine is not None:
+                return engine
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+question_listeners = []
+
+
+def on_question_change(listener):
+    '''
+    registers listener(action, question), called after a question is
+    committed with action 'insert', 'update' or 'delete', or with action
+    'bulk' and no question after many questions changed at once
+    '''
+    question_listeners.append(listener)
+    return listener
 
 
-def setup_db(app, database_path=database_path):
+def notify_question_change(action, question):
+    for listener in question_listeners:
+        listener(action, question)
+
+
+def search_vector(question, answer):
+    '''
+    weighted tsvector of a question ('A') and its answer ('B')
+    '''
+    return func.setweight(
+        func.to_tsvector('simple', func.coalesce(question, '')), 'A').op(
+        '||')(func.setweight(
+            func.to_tsvector('simple', func.coalesce(answer, '')), 'B'))
+
+
+def config_setting(app, name, default=None, type=str):
+    '''
+    setting from the app config, then the environment
+    '''
+    value = app.config.get(name)
+    if value is None:
+        value = os.environ.get(name)
+    if value is None:
+        return default
+    if type is bool and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+
+    return type(value)
+
+
+def engine_options(app, database_path):
+    '''
+    SQLAlchemy engine options from the DATABASE_* settings: pool sizing
+    for a given worker count, connection health checks and a statement
+    timeout in milliseconds. SQLite engines do not use a QueuePool and
+    only get the health check options.
+    '''
+    options = {}
+    connect_args = {}
+    timeout = config_setting(app, 'DATABASE_STATEMENT_TIMEOUT', type=int)
+    sqlite = database_path.startswith('sqlite')
+
+    if sqlite:
+        # SQLite has no statement timeout, use it as the lock wait timeout
+        if timeout is not None:
+            connect_args['timeout'] = timeout / 1000
+    elif timeout is not None:
+        connect_args['options'] = '-c statement_timeout={}'.format(timeout)
+
+    for name, option, option_type, queue_pool in (
+            ('DATABASE_POOL_SIZE', 'pool_size', int, True),
+            ('DATABASE_MAX_OVERFLOW', 'max_overflow', int, True),
+            ('DATABASE_POOL_TIMEOUT', 'pool_timeout', int, True),
+            ('DATABASE_POOL_RECYCLE', 'pool_recycle', int, False),
+            ('DATABASE_POOL_PRE_PING', 'pool_pre_ping', bool, False)):
+        if queue_pool and sqlite:
+            continue
+        value = config_setting(app, name, type=option_type)
+        if value is not None:
+            options[option] = value
+
+    if connect_args:
+        options['connect_args'] = connect_args
+
+    return options
+
+
+def setup_db(app, database_path=None):
     '''
     setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The database URL
+    is, in order, the database_path argument, the DATABASE_URL setting of
+    the app config or the environment, or the local trivia database.
+    The schema is not created here, see the `flask init-db` command.
     '''
+    if database_path is None:
+        database_path = config_setting(
+            app, 'DATABASE_URL',
+            app.config.get('SQLALCHEMY_DATABASE_URI') or
+            default_database_path)
+
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app,
+                                                             database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+    app.extensions['category_cache'] = VersionedCache(
+        'categories', Category.load_map,
+        ttl=app.config.get('CATEGORY_CACHE_TTL', 30))
+    app.extensions['question_version'] = VersionedCache(
+        'questions', lambda: None,
+        ttl=app.config.get('DATASET_VERSION_TTL', 1))
+
+
+class VersionedCache:
+    '''
+    VersionedCache
+    process local read-through cache of a value loaded from the database.
+    The shared version the value was loaded at is re-checked at most once
+    every `ttl` seconds, and a changed version reloads it, so a write made
+    by any worker reaches every other one.
+    '''
+
+    def __init__(self, name, loader, ttl=30):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._version = None
+        self._modified = None
+        self._checked_at = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.ttl:
+            return self._value
+
+        version, modified = Version.state(self.name)
+        if version != self._version:
+            self._value = self.loader()
+            self._version = version
+        self._modified = modified
+        self._checked_at = now
+
+        return self._value
+
+    def version(self):
+        '''
+        shared version the cached value was loaded at
+        '''
+        self.get()
+        return self._version
+
+    def modified(self):
+        '''
+        seconds since the epoch of the last bump of the version, None when
+        it was never recorded
+        '''
+        self.get()
+        return self._modified
+
+    def invalidate(self):
+        self._version = None
+        self._modified = None
+        self._value = None
 
 
 class Question(db.Model):
@@ -26,13 +207,20 @@ class Question(db.Model):
     Question
     '''
     __tablename__ = 'questions'
+    __table_args__ = (
+        # per-category listings, counts and quiz picks scan only this index
+        Index('ix_questions_category_id', 'category', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
-    # category = Column(Integer)
+    category = Column(Integer, ForeignKey('categories.id', name='category',
+                                          onupdate='CASCADE',
+                                          ondelete='SET NULL'))
     difficulty = Column(Integer)
+    # full-text search document, only filled on PostgreSQL
+    search_vector = Column(TSVECTOR().with_variant(String, 'sqlite'))
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -41,15 +229,49 @@ class Question(db.Model):
         self.difficulty = difficulty
 
     def insert(self):
+        self.refresh_search_vector()
         db.session.add(self)
+        Category.adjust_count(self.category, 1)
+        Version.bump('questions')
         db.session.commit()
+        Question.version_cache().invalidate()
+        notify_question_change('insert', self)
 
     def update(self):
+        self.refresh_search_vector()
+        history = inspect(self).attrs.category.history
+        for category in history.deleted:
+            Category.adjust_count(category, -1)
+        for category in history.added:
+            Category.adjust_count(category, 1)
+        Version.bump('questions')
         db.session.commit()
+        Question.version_cache().invalidate()
+        notify_question_change('update', self)
 
     def delete(self):
         db.session.delete(self)
+        Category.adjust_count(self.category, -1)
+        Version.bump('questions')
         db.session.commit()
+        Question.version_cache().invalidate()
+        notify_question_change('delete', self)
+
+    @classmethod
+    def version_cache(cls):
+        return db.get_app().extensions['question_version']
+
+    @classmethod
+    def dataset_version(cls):
+        '''
+        version of the questions, bumped by every question write and
+        re-read from the database at most every DATASET_VERSION_TTL seconds
+        '''
+        return cls.version_cache().version()
+
+    def refresh_search_vector(self):
+        if db.engine.dialect.name == 'postgresql':
+            self.search_vector = search_vector(self.question, self.answer)
 
     def format(self):
         return {
@@ -61,6 +283,11 @@ class Question(db.Model):
         }
 
 
+event.listen(Question.__table__, 'after_create', DDL(
+    'CREATE INDEX ix_questions_search_vector ON questions '
+    'USING gin (search_vector)').execute_if(dialect='postgresql'))
+
+
 class Category(db.Model):
     '''
     Category
@@ -69,12 +296,279 @@ class Category(db.Model):
 
     id = Column(Integer, primary_key=True)
     type = Column(String)
+    # kept up to date by the Question write methods
+    question_count = Column(Integer, nullable=False, default=0,
+                            server_default='0')
 
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        Version.bump('categories')
+        db.session.commit()
+        Category.cache().invalidate()
+
+    def update(self):
+        Version.bump('categories')
+        db.session.commit()
+        Category.cache().invalidate()
+
+    def delete(self):
+        db.session.delete(self)
+        Version.bump('categories')
+        db.session.commit()
+        Category.cache().invalidate()
+
+    @classmethod
+    def adjust_count(cls, category_id, delta):
+        '''
+        adds delta to the question count of a category within the current
+        transaction
+        '''
+        if category_id is not None:
+            cls.query.filter(cls.id == category_id).update(
+                {cls.question_count: cls.question_count + delta},
+                synchronize_session=False)
+
+    @classmethod
+    def question_counts(cls):
+        '''
+        {id: question_count} dictionary of every category
+        '''
+        return dict(db.session.query(cls.id, cls.question_count))
+
+    @classmethod
+    def total_count_query(cls):
+        '''
+        SELECT of the question count of every category, plus the questions
+        without a category, which no counter holds and the (category, id)
+        index counts
+        '''
+        uncategorized = select([func.count(Question.id)]).\
+            where(Question.category.is_(None)).as_scalar()
+        return select([func.coalesce(func.sum(cls.question_count), 0) +
+                       uncategorized])
+
+    @classmethod
+    def count_questions(cls, category_id=None):
+        '''
+        question count of one category, or of all of them
+        '''
+        if category_id is None:
+            return db.session.scalar(cls.total_count_query()) or 0
+
+        return db.session.query(cls.question_count).\
+            filter(cls.id == category_id).scalar() or 0
+
+    @classmethod
+    def reconcile_counts(cls):
+        '''
+        recomputes every question count from the questions table
+        '''
+        counts = db.session.query(func.count(Question.id)).\
+            filter(Question.category == cls.id).\
+            correlate(cls).as_scalar()
+        cls.query.update({cls.question_count: counts},
+                         synchronize_session=False)
+        # the counts are part of the questions responses
+        Version.bump('questions')
+        db.session.commit()
+        Question.version_cache().invalidate()
+
+    @classmethod
+    def load_map(cls):
+        return {category.id: category.type
+                for category in cls.query.order_by(cls.id).all()}
+
+    @classmethod
+    def cache(cls):
+        return db.get_app().extensions['category_cache']
+
+    @classmethod
+    def categories_map(cls):
+        '''
+        cached {id: type} dictionary of every category
+        '''
+        return cls.cache().get()
+
+    @classmethod
+    def invalidate_cache(cls):
+        '''
+        drops the cached categories of every worker
+        '''
+        Version.bump('categories')
+        db.session.commit()
+        cls.cache().invalidate()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'question_count': self.question_count
+        }
+
+
+class Version(db.Model):
+    '''
+    Version
+    counter bumped whenever a cached dataset changes
+    '''
+    __tablename__ = 'versions'
+    # rows created by `flask init-db`
+    DATASETS = ('questions', 'categories')
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+    # seconds since the epoch of the last bump, the Last-Modified date of
+    # the read responses
+    updated_at = Column(Float)
+
+    def __init__(self, name, value=0):
+        self.name = name
+        self.value = value
+        self.updated_at = time.time()
+
+    @classmethod
+    def current(cls, name):
+        return db.session.query(cls.value).\
+            filter(cls.name == name).scalar() or 0
+
+    @classmethod
+    def state(cls, name):
+        '''
+        (value, updated_at) of a version, (0, None) before it is seeded
+        '''
+        state = db.session.query(cls.value, cls.updated_at).\
+            filter(cls.name == name).first()
+
+        return (state[0] or 0, state[1]) if state else (0, None)
+
+    @classmethod
+    def seed(cls):
+        '''
+        creates the missing rows of the DATASETS versions, so the first
+        writes of concurrent workers only ever update them
+        '''
+        existing = set(name for (name,) in db.session.query(cls.name))
+        for name in cls.DATASETS:
+            if name not in existing:
+                db.session.add(cls(name))
+        db.session.commit()
+
+    @classmethod
+    def bump(cls, name):
+        '''
+        increments a version within the current transaction
+        '''
+        updated = cls.query.filter(cls.name == name).\
+            update({cls.value: cls.value + 1, cls.updated_at: time.time()},
+                   synchronize_session=False)
+        if not updated:
+            # not seeded yet, see seed
+            db.session.add(cls(name, 1))
+
+
+class Job(db.Model):
+    '''
+    Job
+    background maintenance job, queued in the database and claimed by the
+    job workers of any process
+    '''
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # the workers look for the oldest queued or stalled job
+        Index('ix_jobs_status_id', 'status', 'id'),
+    )
+
+    # arguments referring to uploaded data, left out of the API responses
+    UPLOAD_ARGUMENTS = ('upload', 'data')
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='queued')
+    # keyword arguments and return value of the job, in JSON
+    arguments = Column(Text)
+    result = Column(Text)
+    error = Column(Text)
+    progress = Column(Integer, nullable=False, default=0)
+    total = Column(Integer)
+    attempts = Column(Integer, nullable=False, default=0)
+    # seconds since the epoch
+    created_at = Column(Float, nullable=False)
+    started_at = Column(Float)
+    updated_at = Column(Float)
+    finished_at = Column(Float)
+
+    def __init__(self, kind, arguments=None):
+        self.kind = kind
+        self.status = 'queued'
+        self.arguments = json.dumps(arguments or {})
+        self.progress = 0
+        self.attempts = 0
+        self.created_at = time.time()
+
     def format(self):
         return {
             'id': self.id,
-            'type': self.type
+            'kind': self.kind,
+            'status': self.status,
+            'arguments': {
+                name: value for name, value
+                in json.loads(self.arguments or '{}').items()
+                if name not in self.UPLOAD_ARGUMENTS},
+            'progress': self.progress,
+            'total': self.total,
+            'attempts': self.attempts,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'updated_at': self.updated_at,
+            'finished_at': self.finished_at
         }
+
+
+class Upload(db.Model):
+    '''
+    Upload
+    request body staged in chunks for a background job, such as a bulk
+    import, so the job arguments only hold its key
+    '''
+    __tablename__ = 'uploads'
+    CHUNK_SIZE = 1 << 20
+
+    key = Column(String, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+
+    @classmethod
+    def store(cls, stream):
+        '''
+        copies a binary stream, CHUNK_SIZE bytes per row, within the
+        current transaction; returns the key of the upload
+        '''
+        key = uuid.uuid4().hex
+        for position, data in enumerate(
+                iter(lambda: stream.read(cls.CHUNK_SIZE), b'')):
+            db.session.execute(cls.__table__.insert(), {
+                'key': key, 'position': position, 'data': data})
+
+        return key
+
+    @classmethod
+    def chunks(cls, key):
+        '''
+        the chunks of an upload in order, read one row at a time
+        '''
+        for position in itertools.count():
+            data = db.session.query(cls.data).\
+                filter(cls.key == key, cls.position == position).scalar()
+            if data is None:
+                return
+            yield data
+
+    @classmethod
+    def discard(cls, key):
+        cls.query.filter(cls.key == key).delete(synchronize_session=False)
+        db.session.commit()
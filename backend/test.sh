@@ -2,6 +2,10 @@
 dropdb trivia_test
 createdb trivia_test
 psql trivia_test -f trivia.psql
+for migration in migrations/*.sql; do
+    psql trivia_test -f "$migration"
+done
+DATABASE_URL=postgres://localhost:5432/trivia_test FLASK_APP=flaskr flask init-db
 clear
 python -m unittest -v test_flaskr.py
 dropdb trivia_test
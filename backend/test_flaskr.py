@@ -1,10 +1,49 @@
+import asyncio
 import os
+from array import array
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+
+from benchmark import run_benchmark
+from flask import jsonify
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.asgi import create_asgi_app
+from flaskr.bulk import read_dump, import_questions, iter_chunk_lines, \
+    BulkImportError
+from flaskr.encoding import dumps, string_keys
+from flaskr.response_cache import MemoryCache, SQLiteCache, RedisCache
+from flaskr.warmup import warm_up
+from flaskr.replicas import ReplicaRouter
+from flaskr.admission import SQLiteBuckets
+from flaskr.quiz import pick_unseen, quiz_pools
+from flaskr.jobs import submit_job, run_job
+from models import db, Question, Category, Version, Job, Upload, \
+    engine_options
+
+
+DUMPS = {}
+
+
+def load_dump(path):
+    """
+    creates the schema and loads the COPY blocks of a pg_dump file such
+    as trivia.psql, parsed once per run, to seed databases that cannot
+    restore it, like SQLite
+    """
+    if path not in DUMPS:
+        DUMPS[path] = list(read_dump(path))
+
+    db.create_all()
+    for table, rows in DUMPS[path]:
+        db.session.execute(db.Model.metadata.tables[table].insert(), rows)
+
+    Category.reconcile_counts()
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,19 +51,24 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format('localhost:5432',
-                                                       self.database_name)
-        setup_db(self.app, self.database_path)
+        self.database_path = os.environ.get(
+            'TRIVIA_TEST_DATABASE_URL',
+            "postgres://{}/{}".format('localhost:5432', self.database_name))
+        self.app = self.create_test_app()
+        self.client = self.app.test_client
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+    def create_test_app(self, **config):
+        """Create an app on the test database with extra settings."""
+        config['DATABASE_URL'] = self.database_path
+        app = create_app(config)
+
+        # test.sh restores trivia.psql in PostgreSQL, seed other databases
+        if not self.database_path.startswith('postgres'):
+            with app.app_context():
+                load_dump('trivia.psql')
+
+        return app
 
     def tearDown(self):
         """Executed after reach test"""
@@ -36,6 +80,65 @@ class TriviaTestCase(unittest.TestCase):
     expected errors.
     """
 
+    def test_init_db_command(self):
+        """
+        schema creation command test function
+        """
+        app = create_app({'DATABASE_URL': 'sqlite://'})
+        with app.app_context():
+            self.assertFalse(db.engine.has_table('questions'))
+
+        result = app.test_cli_runner().invoke(args=['init-db'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Created the missing tables', result.output)
+        with app.app_context():
+            self.assertTrue(db.engine.has_table('questions'))
+            self.assertTrue(db.engine.has_table('versions'))
+            # seeded, so the first writes of the workers only update them
+            self.assertEqual(sorted(name for (name,) in
+                                    db.session.query(Version.name)),
+                             ['categories', 'questions'])
+
+    def test_warm_up(self):
+        """
+        startup warm-up test function
+        """
+        timings = warm_up(self.app)
+
+        self.assertEqual(sorted(timings), sorted([
+            'connections', 'versions', 'categories', 'quiz_pools',
+            'quiz_index',
+            'suggestion_index', 'first_page'] + (
+                [] if self.database_path.startswith('postgres')
+                else ['search_index'])))
+        self.assertTrue(len(self.app.extensions['quiz_index']) > 0)
+
+    def test_engine_options(self):
+        """
+        database engine settings test function
+        """
+        self.app.config.update({
+            'DATABASE_POOL_SIZE': '20',
+            'DATABASE_MAX_OVERFLOW': 5,
+            'DATABASE_POOL_PRE_PING': 'true',
+            'DATABASE_POOL_RECYCLE': 1800,
+            'DATABASE_STATEMENT_TIMEOUT': 5000
+        })
+        options = engine_options(self.app, 'postgres://localhost:5432/trivia')
+
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 5)
+        self.assertEqual(options['pool_pre_ping'], True)
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+
+        options = engine_options(self.app, 'sqlite://')
+        self.assertEqual(options['connect_args'], {'timeout': 5})
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('max_overflow', options)
+        self.assertEqual(options['pool_recycle'], 1800)
+
     def test_retrieve_categories(self):
         """
         get categories endpoint test function
@@ -49,6 +152,65 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertTrue(data['total_categories'])
 
+    def test_categories_cache(self):
+        """
+        categories cache invalidation test function
+        """
+        with self.app.app_context():
+            categories = Category.categories_map()
+            self.assertIs(Category.categories_map(), categories)
+
+            category = Category('Music')
+            category.insert()
+            self.assertIn(category.id, Category.categories_map())
+            category.delete()
+            self.assertNotIn(category.id, Category.categories_map())
+
+            # another worker bumping the version busts this one's cache
+            categories = Category.categories_map()
+            Category.cache().ttl = 0
+            Version.bump('categories')
+            db.session.commit()
+            self.assertIsNot(Category.categories_map(), categories)
+
+    def test_category_question_counts(self):
+        """
+        categories question counts test function
+        """
+        data = json.loads(self.client().get('/categories').data)
+        counts = data['question_counts']
+        total = json.loads(self.client().get('/questions').data)[
+            'total_questions']
+        self.assertEqual(sum(counts.values()), total)
+
+        self.client().post('/questions', json={
+            'question': 'counted question',
+            'answer': 'counted answer',
+            'category': 2,
+            'difficulty': 1
+        })
+        data = json.loads(self.client().get('/categories').data)
+        self.assertEqual(data['question_counts']['2'], counts['2'] + 1)
+
+        with self.app.app_context():
+            question = Question.query.filter(
+                Question.question == 'counted question').first()
+            question.category = 3
+            question.update()
+        data = json.loads(self.client().get('/categories').data)
+        self.assertEqual(data['question_counts']['2'], counts['2'])
+        self.assertEqual(data['question_counts']['3'], counts['3'] + 1)
+
+        data = json.loads(self.client().get('/categories/3/questions').data)
+        self.assertEqual(data['total_questions'], counts['3'] + 1)
+
+        with self.app.app_context():
+            question = Question.query.filter(
+                Question.question == 'counted question').first()
+            self.client().delete('questions/{}'.format(question.id))
+        data = json.loads(self.client().get('/categories').data)
+        self.assertEqual(data['question_counts'], counts)
+
     def test_retrieve_questions(self):
         """
         get questions endpoint test function
@@ -64,6 +226,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['current_category'])
         self.assertTrue(data['categories'])
 
+    def test_retrieve_questions_minimal(self):
+        """
+        get questions endpoint response shaping test function
+        """
+        response = self.client().get('/questions?view=minimal')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'])
+        self.assertTrue(data['total_questions'])
+        self.assertNotIn('categories', data)
+        self.assertNotIn('current_category', data)
+
+        response = self.client().get('/questions?fields=total_questions')
+        data = json.loads(response.data)
+        self.assertEqual(sorted(data), ['status_code', 'status_message',
+                                        'success', 'total_questions'])
+
     def test_retrieve_questions_422(self):
         """
         get questions endpoint error test function
@@ -77,6 +258,216 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'Unprocessable')
         self.assertTrue(data['error'], 422)
 
+    def test_retrieve_questions_etag(self):
+        """
+        get questions endpoint conditional request test function
+        """
+        response = self.client().get('/questions')
+        etag = response.headers['ETag']
+        self.assertTrue(etag)
+        self.assertIn('max-age', response.headers['Cache-Control'])
+
+        response = self.client().get('/questions',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.client().get('/questions?page=2',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        self.client().post('/questions', json={
+            'question': 'versioned question',
+            'answer': 'versioned answer',
+            'category': 1,
+            'difficulty': 1
+        })
+        response = self.client().get('/questions',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_retrieve_questions_last_modified(self):
+        """
+        get questions endpoint Last-Modified test function
+        """
+        response = self.client().get('/questions')
+        modified = response.headers['Last-Modified']
+        self.assertTrue(modified)
+
+        response = self.client().get('/questions',
+                                     headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client().get('/questions', headers={
+            'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+        # If-None-Match takes precedence
+        response = self.client().get('/questions', headers={
+            'If-Modified-Since': modified, 'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_reconcile_counts_etag(self):
+        """
+        reconciled question counts change the categories ETag
+        """
+        etag = self.client().get('/categories').headers['ETag']
+
+        with self.app.app_context():
+            Category.reconcile_counts()
+        response = self.client().get('/categories',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        with self.app.app_context():
+            run_job(submit_job('reconcile_counts').id)
+        response = self.client().get('/categories',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_response_cache(self):
+        """
+        shared response cache test function
+        """
+        handle, cache_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, cache_file)
+
+        for setting in ('memory', 'sqlite:///' + cache_file):
+            app = self.create_test_app(RESPONSE_CACHE=setting)
+            cache = app.extensions['response_cache']
+            client = app.test_client()
+
+            first = client.get('/questions?page=2')
+            with app.app_context():
+                self.assertEqual(cache.get(first.headers['ETag'].strip('"')),
+                                 first.data)
+            second = client.get('/questions?page=2')
+            self.assertEqual(second.data, first.data)
+            self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+
+            client.post('/questions', json={
+                'question': 'cached question',
+                'answer': 'cached answer',
+                'category': 1,
+                'difficulty': 1
+            })
+            self.assertIsNone(cache.get(first.headers['ETag'].strip('"')))
+            response = client.get('/categories/1/questions?page=100')
+            self.assertEqual(response.status_code, 422)
+
+    def test_response_cache_cleared_once(self):
+        """
+        response cache cleared once per question write transaction test
+        function
+        """
+        app = self.create_test_app(RESPONSE_CACHE='memory')
+        cache = app.extensions['response_cache']
+        clears = []
+        cache.clear = lambda: clears.append(True)
+        client = app.test_client()
+
+        data = json.loads(client.patch('/questions', json={'operations': [
+            {'op': 'create', 'question': 'cleared question {}'.format(n),
+             'answer': 'cleared', 'category': 1, 'difficulty': 1}
+            for n in range(3)]}).data)
+        self.assertEqual(len(clears), 1)
+
+        client.patch('/questions', json={'operations': [
+            {'op': 'delete', 'id': question_id}
+            for question_id in data['created']]})
+        self.assertEqual(len(clears), 2)
+
+    def test_redis_cache_error_reply(self):
+        """
+        redis error replies as cache misses test function
+        """
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def reply_errors():
+            connection, _ = server.accept()
+            with connection:
+                while connection.recv(4096):
+                    connection.sendall(b'-NOAUTH Authentication required.\r\n')
+
+        threading.Thread(target=reply_errors, daemon=True).start()
+        cache = RedisCache('redis://127.0.0.1:{}/0'.format(
+            server.getsockname()[1]), ttl=60)
+        self.assertIsNone(cache.get('key'))
+
+    def test_redis_cache_backoff(self):
+        """
+        unreachable redis server skipped for a while test function
+        """
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        cache = RedisCache('redis://127.0.0.1:{}/0'.format(
+            closed.getsockname()[1]), ttl=60, retry_after=0.2)
+        closed.close()
+        self.assertIsNone(cache.get('key'))
+
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        cache.address = server.getsockname()
+
+        # still backing off, the server is not tried
+        self.assertIsNone(cache.get('key'))
+        server.setblocking(False)
+        self.assertRaises(BlockingIOError, server.accept)
+        server.setblocking(True)
+
+        def reply_hit():
+            connection, _ = server.accept()
+            with connection:
+                connection.recv(4096)
+                connection.sendall(b'$3\r\nhit\r\n')
+
+        threading.Thread(target=reply_hit, daemon=True).start()
+        time.sleep(0.25)
+        self.assertEqual(cache.get('key'), b'hit')
+
+    def test_response_cache_lru(self):
+        """
+        response cache eviction test function
+        """
+        handle, cache_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, cache_file)
+
+        for cache in (MemoryCache(10), SQLiteCache(cache_file, 10, 60)):
+            cache.set('a', b'1234')
+            cache.set('b', b'1234')
+            self.assertEqual(cache.get('a'), b'1234')
+            cache.set('c', b'1234')
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(cache.get('a'), b'1234')
+            cache.set('too big', b'12345678901')
+            self.assertIsNone(cache.get('too big'))
+
+            cache.clear()
+            self.assertIsNone(cache.get('a'))
+
+    def test_retrieve_questions_after_id(self):
+        """
+        get questions endpoint keyset cursor test function
+        """
+        response = self.client().get('/questions?after_id=10')
+        data = json.loads(response.data)
+
+        self.assertEqual(data['success'], True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['questions'])
+        self.assertTrue(all(question['id'] > 10
+                            for question in data['questions']))
+        self.assertTrue(data['total_questions'] > len(data['questions']))
+
     def test_delete_questions_422(self):
         """
         delete questions endpoint error test function
@@ -100,6 +491,77 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['status_message'], 'OK')
 
+    def test_batch_questions(self):
+        """
+        batched question writes test function
+        """
+        response = self.client().patch('/questions', json={'operations': [
+            {'op': 'create', 'question': 'first batch question',
+             'answer': 'one', 'category': 1, 'difficulty': 1},
+            {'op': 'create', 'question': 'second batch question',
+             'answer': 'two', 'category': 1, 'difficulty': 2}
+        ]})
+        data = json.loads(response.data)
+        first, second = data['created']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['updated'], [])
+
+        with self.app.app_context():
+            counts = Category.question_counts()
+        response = self.client().patch('/questions', json={'operations': [
+            {'op': 'update', 'id': first, 'category': 2, 'difficulty': 5},
+            {'op': 'delete', 'id': second},
+            {'op': 'delete', 'id': 5000}
+        ]})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['updated'], [first])
+        self.assertEqual(data['deleted'], [second])
+        with self.app.app_context():
+            question = Question.query.get(first)
+            self.assertEqual((question.category, question.difficulty),
+                             (2, 5))
+            self.assertIsNone(Question.query.get(second))
+            self.assertEqual(Category.question_counts()[1], counts[1] - 2)
+            self.assertEqual(Category.question_counts()[2], counts[2] + 1)
+
+        response = self.client().patch('/questions', json={'operations': [
+            {'op': 'delete', 'id': first}]})
+        self.assertEqual(json.loads(response.data)['deleted'], [first])
+
+    def test_batch_questions_422(self):
+        """
+        batched question writes error test function
+        """
+        response = self.client().patch('/questions', json={'operations': [
+            {'op': 'delete', 'id': 2},
+            {'op': 'update', 'id': 5000, 'answer': 'missing'},
+            {'op': 'create', 'question': 'no answer', 'category': 1,
+             'difficulty': 1}
+        ]})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['errors'], [
+            {'index': 2, 'error': 'answer is required'}])
+
+        response = self.client().patch('/questions', json={'operations': [
+            {'op': 'delete', 'id': 2},
+            {'op': 'update', 'id': 5000, 'answer': 'missing'}
+        ]})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['errors'], [
+            {'index': 1, 'error': 'question 5000 not found'}])
+        with self.app.app_context():
+            self.assertIsNotNone(Question.query.get(2))
+
+        response = self.client().patch('/questions', json={})
+        self.assertEqual(response.status_code, 400)
+
     def test_create_question(self):
         """
         questions creation endpoint test function
@@ -117,6 +579,33 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['status_message'], 'OK')
 
+    def test_create_question_minimal(self):
+        """
+        questions creation endpoint minimal response test function
+        """
+        new_question = {
+            'question': 'minimal question',
+            'answer': 'minimal answer',
+            'category': 1,
+            'difficulty': 1
+        }
+        response = self.client().post('/questions?view=minimal',
+                                      json=new_question)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['created'])
+        self.assertNotIn('questions', data)
+
+        response = self.client().delete(
+            '/questions/{}?view=minimal'.format(data['created']))
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(data), ['deleted', 'status_code',
+                                        'status_message', 'success'])
+
     def test_create_question_422(self):
         """
         questions creation endpoint error test function
@@ -134,6 +623,262 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unprocessable')
 
+        for category in (None, 'abc', 1000):
+            response = self.client().post('/questions', json={
+                'question': 'no category', 'answer': 'none',
+                'category': category, 'difficulty': 1})
+            self.assertEqual(response.status_code, 422, category)
+
+    def test_total_questions_uncategorized(self):
+        """
+        total questions counting the questions without a category test
+        function
+        """
+        with self.app.app_context():
+            db.session.execute(Question.__table__.insert().values(
+                question='uncategorized', answer='none', difficulty=1))
+            # as ON DELETE SET NULL does
+            Question.query.filter(Question.category == 1).update(
+                {Question.category: None}, synchronize_session=False)
+            Category.query.filter(Category.id == 1).delete()
+            db.session.commit()
+            total = Question.query.count()
+
+        data = json.loads(self.client().get('/questions').data)
+        self.assertEqual(data['total_questions'], total)
+
+    def test_bulk_import_questions(self):
+        """
+        questions bulk import endpoint test function
+        """
+        body = '\n'.join([
+            json.dumps({'question': 'bulk question one', 'answer': 'one',
+                        'category': 1, 'difficulty': 1}),
+            json.dumps({'question': 'bulk question two', 'answer': 'two',
+                        'category': 2, 'difficulty': 2}),
+            json.dumps({'question': '', 'answer': 'three',
+                        'category': 1, 'difficulty': 1}),
+            'not json'
+        ])
+        response = self.client().post('/questions/bulk', data=body,
+                                      content_type='application/x-ndjson')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['rejected'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [3, 4])
+
+        response = self.client().post('/questions_by_phrase',
+                                      json={'searchTerm': "bulk question"})
+        self.assertEqual(json.loads(response.data)['total_questions'], 2)
+
+    def test_bulk_import_questions_invalid_utf8(self):
+        """
+        questions bulk import of undecodable lines test function
+        """
+        valid = {'question': 'decoded question', 'answer': 'decoded',
+                 'category': 1, 'difficulty': 1}
+        body = b'\n'.join([
+            json.dumps(valid).encode(),
+            json.dumps(dict(valid, answer='x')).encode().replace(
+                b'x', b'\xff\xfe'),
+            json.dumps(valid).encode()
+        ])
+        response = self.client().post('/questions/bulk', data=body,
+                                      content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['errors'], [
+            {'line': 2, 'error': 'answer is not valid UTF-8'}])
+
+        body = b'question,answer,category,difficulty\n' \
+            b'csv \xff question,answer,1,1\ncsv question,answer,1,1\n'
+        data = json.loads(self.client().post(
+            '/questions/bulk', data=body, content_type='text/csv').data)
+        self.assertEqual((data['inserted'], data['rejected']), (1, 1))
+
+    def test_bulk_import_questions_failure(self):
+        """
+        questions bulk import stopped by an error test function
+        """
+        def records():
+            for number in range(1, 4):
+                yield number, {'question': 'stopped question',
+                               'answer': 'stopped', 'category': 1,
+                               'difficulty': 1}, None
+            yield 4, None, 'invalid JSON'
+            raise IOError('connection reset')
+
+        with self.app.app_context():
+            with self.assertRaises(BulkImportError) as raised:
+                import_questions(records(), batch_size=2)
+            self.assertEqual(raised.exception.inserted, 2)
+            self.assertEqual(raised.exception.rejected, 1)
+            self.assertEqual(Question.query.filter(
+                Question.question == 'stopped question').count(), 2)
+
+    def test_bulk_import_questions_background(self):
+        """
+        questions bulk import queued as a background job test function
+        """
+        body = '\n'.join([
+            json.dumps({'question': 'queued question one', 'answer': 'one',
+                        'category': 1, 'difficulty': 1}),
+            json.dumps({'question': 'queued question two', 'answer': 'two',
+                        'category': 2, 'difficulty': 2}),
+            'not json'
+        ])
+        response = self.client().post('/questions/bulk?background=true',
+                                      data=body,
+                                      content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['job']['kind'], 'import_questions')
+        self.assertEqual(data['job']['status'], 'queued')
+        self.assertEqual(sorted(data['job']['arguments']),
+                         ['columns', 'import_format'])
+        with self.app.app_context():
+            arguments = json.loads(Job.query.get(data['job']['id']).arguments)
+            self.assertNotIn('data', arguments)
+            self.assertEqual(b''.join(Upload.chunks(arguments['upload'])),
+                             body.encode('utf-8'))
+
+        result = self.app.test_cli_runner().invoke(args=['jobs', 'run',
+                                                         '--once'])
+        self.assertIn('Ran 1 jobs', result.output)
+
+        data = json.loads(self.client().get(
+            '/jobs/{}'.format(data['job']['id'])).data)
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertEqual(data['job']['result']['inserted'], 2)
+        self.assertEqual(data['job']['result']['rejected'], 1)
+        with self.app.app_context():
+            self.assertEqual(Upload.query.count(), 0)
+
+        response = self.client().post('/questions_by_phrase',
+                                      json={'searchTerm': "queued question"})
+        self.assertEqual(json.loads(response.data)['total_questions'], 2)
+
+    def test_iter_chunk_lines(self):
+        """
+        lines of chunks split anywhere test function
+        """
+        text = 'ab\r\ncaf\u00e9\n\nlast'.encode('utf-8')
+        for size in (1, 2, 3, len(text)):
+            chunks = [text[start:start + size]
+                      for start in range(0, len(text), size)]
+            self.assertEqual(list(iter_chunk_lines(chunks)),
+                             ['ab', 'caf\u00e9', '', 'last'])
+
+    def test_bulk_import_questions_copy(self):
+        """
+        questions bulk import endpoint COPY format test function
+        """
+        body = '100\tWhat is a tab?\tA \\t character\t1\t1\n\\.\n'
+        response = self.client().post(
+            '/questions/bulk', data=body,
+            content_type='text/tab-separated-values')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['rejected'], 0)
+
+    def test_bulk_import_questions_400(self):
+        """
+        questions bulk import endpoint error test function
+        """
+        response = self.client().post('/questions/bulk', data='a,b',
+                                      content_type='text/plain')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_export_questions(self):
+        """
+        questions export endpoint test function
+        """
+        response = self.client().get('/questions/export?format=csv')
+        lines = response.data.decode('utf-8').splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertTrue(len(lines) > 1)
+
+        response = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in
+                response.data.decode('utf-8').splitlines()]
+        self.assertEqual(len(rows), len(lines) - 1)
+        self.assertEqual(sorted(rows[0]), sorted(
+            ['id', 'question', 'answer', 'category', 'difficulty']))
+
+        response = self.client().get('/questions/export?format=json')
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.data), rows)
+
+    def test_lean_encoding_matches_jsonify(self):
+        """
+        listing responses are byte-compatible with jsonify test function
+        """
+        response = self.client().get('/questions?page=2')
+        with self.app.test_request_context():
+            questions = Question.query.order_by(Question.id).\
+                offset(10).limit(10).all()
+            expected = jsonify({
+                "success": True,
+                "status_code": 200,
+                "status_message": 'OK',
+                "questions": [question.format() for question in questions],
+                "total_questions": Category.count_questions(),
+                "current_category": list(set(
+                    [question.category for question in questions])),
+                "categories": Category.categories_map()
+            }).get_data()
+
+            self.assertEqual(response.data, expected)
+            self.assertEqual(
+                dumps({'b': string_keys({10: 'x', 2: 'y'}), 'a': 'caf\xe9'}),
+                jsonify({'b': {10: 'x', 2: 'y'}, 'a': 'caf\xe9'}).get_data())
+
+    def test_suggest_questions(self):
+        """
+        search type-ahead suggestions test function
+        """
+        response = self.client().get('/questions/suggest?prefix=Who%20disc')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['suggestions'], ['who discovered'])
+
+        response = self.client().get('/questions/suggest?prefix=wh&limit=2')
+        self.assertEqual(len(json.loads(response.data)['suggestions']), 2)
+
+        # answers are never suggested
+        response = self.client().get('/questions/suggest?prefix=flem')
+        self.assertEqual(json.loads(response.data)['suggestions'], [])
+
+        response = self.client().post('/questions', json={
+            'question': 'Which zyzzyva is suggested?',
+            'answer': 'this one',
+            'category': 1,
+            'difficulty': 1
+        })
+        created = json.loads(response.data)['created']
+        response = self.client().get('/questions/suggest?prefix=zyz')
+        self.assertEqual(json.loads(response.data)['suggestions'],
+                         ['zyzzyva'])
+
+        self.client().delete('/questions/{}'.format(created))
+        response = self.client().get('/questions/suggest?prefix=zyz')
+        self.assertEqual(json.loads(response.data)['suggestions'], [])
+
+        response = self.client().get('/questions/suggest?prefix=a&limit=0')
+        self.assertEqual(response.status_code, 400)
+
     def test_questions_by_cat(self):
         """
         get questions by category endpoint test function
@@ -144,6 +889,9 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['status_message'], 'OK')
+        self.assertEqual(data['current_category'], [1])
+        self.assertTrue(all(question['category'] == 1
+                            for question in data['questions']))
 
     def test_questions_by_cat_422(self):
         """
@@ -169,33 +917,190 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['status_message'], 'OK')
 
-    def test_questions_search_400(self):
+    def test_questions_search_ranked(self):
         """
-        questions search endpoint error test function
+        questions search endpoint ranking test function
         """
         response = self.client().post('/questions_by_phrase',
-                                      json={'searchTerm': "abcdefghijklmn"})
-
+                                      json={'searchTerm': "soccer world cup"})  # noqa
         data = json.loads(response.data)
 
-        self.assertEqual(response.status_code, 400)
-        self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Bad Request')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [10, 11])
 
-    def test_play_quizz(self):
+    def test_questions_search_answers(self):
         """
-        play quizz endpoint test function
+        questions search endpoint answers test function
         """
-        response = self.client().post('/quizzes',
-                                      json={'previous_questions': [],
-                                            'quiz_category': {'type': 'History',  # noqa
-                                                              'id': '3'
-                                                              }
-                                            })
+        response = self.client().post('/questions_by_phrase',
+                                      json={'searchTerm': "pollock"})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client().post('/questions_by_phrase',
+                                      json={'searchTerm': "pollock",
+                                            'searchAnswers': True})
         data = json.loads(response.data)
+
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(data['success'], True)
-        self.assertEqual(data['status_message'], 'OK')
+        self.assertEqual(data['questions'][0]['id'], 19)
+
+    def test_questions_search_new_question(self):
+        """
+        questions search endpoint index sync test function
+        """
+        response = self.client().post('/questions_by_phrase',
+                                      json={'searchTerm': "zebra"})
+        self.assertEqual(response.status_code, 400)
+
+        self.client().post('/questions', json={
+            'question': 'How many stripes does a zebra have?',
+            'answer': 'Many',
+            'category': 1,
+            'difficulty': 1
+        })
+        response = self.client().post('/questions_by_phrase',
+                                      json={'searchTerm': "zebra"})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_questions_search_400(self):
+        """
+        questions search endpoint error test function
+        """
+        response = self.client().post('/questions_by_phrase',
+                                      json={'searchTerm': "abcdefghijklmn"})
+
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_play_quizz(self):
+        """
+        play quizz endpoint test function
+        """
+        response = self.client().post('/quizzes',
+                                      json={'previous_questions': [],
+                                            'quiz_category': {'type': 'History',  # noqa
+                                                              'id': '3'
+                                                              }
+                                            })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['status_message'], 'OK')
+
+    def test_play_quizz_skips_previous_questions(self):
+        """
+        play quizz endpoint previous questions test function
+        """
+        response = self.client().post('/quizzes',
+                                      json={'previous_questions': [13, 14],
+                                            'quiz_category': {'type': 'Geography',  # noqa
+                                                              'id': '3'
+                                                              }
+                                            })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], 15)
+
+    def test_play_quizz_exhausted(self):
+        """
+        play quizz endpoint used up pool test function
+        """
+        response = self.client().post('/quizzes',
+                                      json={'previous_questions': [13, 14, 15],  # noqa
+                                            'quiz_category': {'type': 'Geography',  # noqa
+                                                              'id': '3'
+                                                              }
+                                            })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIsNone(data['question'])
+
+    def test_quiz_pools(self):
+        """
+        quiz pools kept in sync with the question writes test function
+        """
+        self.assertIsNone(pick_unseen(array('i', [1, 2, 3]), {1, 2, 3}))
+        for _ in range(20):
+            self.assertIn(pick_unseen(array('i', [1, 3, 5, 7]), {1, 5, 9}),
+                          (3, 7))
+
+        client = self.client()
+        client.post('/quizzes', json={'previous_questions': [],
+                                      'quiz_category': {'id': 1}})
+        with self.app.app_context():
+            pools = quiz_pools()
+            every_question = pools._pools[0]
+            self.assertEqual(list(pools.ids(3)), [13, 14, 15])
+
+        response = client.post('/questions?view=minimal', json={
+            'question': 'Which country has the most lakes?',
+            'answer': 'Canada',
+            'category': 3,
+            'difficulty': 2
+        })
+        created = json.loads(response.data)['created']
+        with self.app.app_context():
+            # applied in place, not rebuilt
+            self.assertIs(pools.current()._pools[0], every_question)
+            self.assertEqual(list(pools.ids(3)), [13, 14, 15, created])
+
+        response = client.post('/quizzes', json={
+            'previous_questions': [13, 14, 15],
+            'quiz_category': {'id': 3}
+        })
+        self.assertEqual(json.loads(response.data)['question']['id'],
+                         created)
+
+        client.delete('/questions/{}'.format(created))
+        with self.app.app_context():
+            self.assertNotIn(created, pools.ids(0))
+
+            # writes of other workers only show in the version
+            Version.bump('questions')
+            db.session.commit()
+            Question.version_cache().invalidate()
+            self.assertIsNot(pools.current()._pools[0], every_question)
+
+    def test_play_quizz_adaptive(self):
+        """
+        play quizz endpoint adaptive difficulty test function
+        """
+        def play(previous_questions, recent_answers):
+            response = self.client().post('/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': {'id': 2},
+                'adaptive': True,
+                'recent_answers': recent_answers
+            })
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.data)['question']
+
+        # Art questions 16, 19, 17 and 18 have difficulties 1 to 4
+        self.assertEqual(play([], [False, False])['id'], 16)
+        self.assertEqual(play([16], [False, False])['id'], 19)
+        self.assertEqual(play([], [True] * 5)['id'], 18)
+        self.assertIsNone(play([16, 17, 18, 19], [True]))
+        # ids sent as strings are excluded too
+        self.assertIsNone(play(['16', '17', '18', '19'], [True]))
+
+        response = self.client().post('/questions', json={
+            'question': 'Which painting is the hardest to name?',
+            'answer': 'Untitled',
+            'category': 2,
+            'difficulty': 5
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(play([], [True] * 5)['difficulty'], 5)
 
     def test_play_quizz_404(self):
         """
@@ -212,6 +1117,928 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource Not found')
 
+    def test_quiz_session(self):
+        """
+        quiz session endpoints test function
+        """
+        response = self.client().post('/quizzes/sessions',
+                                      json={'quiz_category': {'type': 'Geography',  # noqa
+                                                              'id': '3'
+                                                              }
+                                            })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 3)
+
+        url = '/quizzes/sessions/{}/next'.format(data['session_id'])
+        seen = set()
+        for remaining in (2, 1, 0):
+            data = json.loads(self.client().get(url).data)
+            self.assertEqual(data['question']['category'], 3)
+            self.assertEqual(data['remaining_questions'], remaining)
+            seen.add(data['question']['id'])
+        self.assertEqual(seen, {13, 14, 15})
+
+        response = self.client().get(url)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(data['question'])
+        self.assertEqual(data['remaining_questions'], 0)
+
+    def test_quiz_session_deck_size(self):
+        """
+        quiz session deck capped at QUIZ_SESSION_QUESTIONS test function
+        """
+        client = self.create_test_app(QUIZ_SESSION_QUESTIONS=5).test_client()
+        data = json.loads(client.post('/quizzes/sessions', json={
+            'quiz_category': {'id': 0}}).data)
+        self.assertEqual(data['total_questions'], 5)
+
+        url = '/quizzes/sessions/{}/next'.format(data['session_id'])
+        seen = set(json.loads(client.get(url).data)['question']['id']
+                   for _ in range(5))
+        self.assertEqual(len(seen), 5)
+        self.assertIsNone(json.loads(client.get(url).data)['question'])
+
+    def test_quiz_session_404(self):
+        """
+        quiz session endpoints error test function
+        """
+        response = self.client().get('/quizzes/sessions/abcde/next')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Resource Not found')
+
+    def test_play_quizz_rate_limited(self):
+        """
+        per client and per route rate limits test function
+        """
+        app = self.create_test_app(RATE_LIMIT_CLIENT=0.001,
+                                   RATE_LIMIT_CLIENT_BURST=2)
+        body = {'previous_questions': [], 'quiz_category': {'id': 2}}
+
+        for _ in range(2):
+            response = app.test_client().post('/quizzes', json=body)
+            self.assertEqual(response.status_code, 200)
+        response = app.test_client().post('/quizzes', json=body)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(data['message'], 'Too Many Requests')
+        self.assertGreater(int(response.headers['Retry-After']), 1)
+
+        # other clients and other routes have their own buckets
+        response = app.test_client().post(
+            '/quizzes', json=body, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 200)
+        response = app.test_client().post('/questions_by_phrase',
+                                          json={'searchTerm': 'title'})
+        self.assertEqual(response.status_code, 200)
+        # the other endpoints are never limited
+        self.assertEqual(app.test_client().get('/questions').status_code, 200)
+
+        app = self.create_test_app(RATE_LIMIT_ROUTE=0.001,
+                                   RATE_LIMIT_ROUTE_BURST=1)
+        app.test_client().post('/quizzes', json=body)
+        response = app.test_client().post(
+            '/quizzes', json=body, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_questions_search_concurrency_limit(self):
+        """
+        concurrency gate test function
+        """
+        app = self.create_test_app(CONCURRENCY_LIMIT=1,
+                                   CONCURRENCY_RETRY_AFTER=2)
+        gate = app.extensions['admission'].gate
+
+        # a request in flight holds the only slot
+        self.assertTrue(gate.acquire())
+        response = app.test_client().post('/questions_by_phrase',
+                                          json={'searchTerm': 'title'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(data['message'], 'Service Unavailable')
+        self.assertEqual(response.headers['Retry-After'], '2')
+        gate.release()
+
+        # slots are released after the requests, errors included
+        for _ in range(3):
+            response = app.test_client().post('/questions_by_phrase',
+                                              json={'searchTerm': 'title'})
+            self.assertEqual(response.status_code, 200)
+            response = app.test_client().post(
+                '/questions_by_phrase?page=0', json={'searchTerm': 'title'})
+            self.assertEqual(response.status_code, 400)
+
+    def test_admission_under_load(self):
+        """
+        admission control of concurrent requests test function
+        """
+        app = self.create_test_app(RATE_LIMIT_ROUTE=0.001,
+                                   RATE_LIMIT_ROUTE_BURST=6,
+                                   CONCURRENCY_LIMIT=2)
+        body = {'previous_questions': [], 'quiz_category': {'id': 0}}
+        statuses = []
+        start = threading.Barrier(12)
+
+        def play():
+            client = app.test_client()
+            start.wait()
+            statuses.append(client.post('/quizzes', json=body).status_code)
+
+        threads = [threading.Thread(target=play) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # exactly the burst gets past the rate limit, the gate may turn
+        # some of them away
+        self.assertEqual(statuses.count(429), 6)
+        self.assertEqual(statuses.count(200) + statuses.count(503), 6)
+        self.assertGreaterEqual(statuses.count(200), 1)
+
+        # every slot was given back
+        gate = app.extensions['admission'].gate
+        self.assertTrue(gate.acquire() and gate.acquire())
+
+    def test_rate_limit_shared_store(self):
+        """
+        token buckets shared by workers in a SQLite file test function
+        """
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        try:
+            workers = [SQLiteBuckets(path) for _ in range(2)]
+            waits = []
+
+            def take(buckets):
+                for _ in range(5):
+                    waits.append(buckets.take('route:play_quiz', 0.001, 4))
+
+            threads = [threading.Thread(target=take, args=(buckets,))
+                       for buckets in workers for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(waits.count(0), 4)
+            self.assertEqual(len(waits), 20)
+            self.assertGreater(min(wait for wait in waits if wait), 900)
+        finally:
+            os.remove(path)
+
+    def room_events(self, data):
+        """Parse the Server-Sent Events of a stream body."""
+        events = []
+        for block in data.decode('utf-8').split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines()
+                          if not line.startswith(':'))
+            if fields:
+                events.append((int(fields['id']), fields['event'],
+                               json.loads(fields['data'])))
+        return events
+
+    def test_quiz_room(self):
+        """
+        multiplayer quiz room test function
+        """
+        client = self.client()
+        response = client.post('/rooms', json={
+            'quiz_category': {'type': 'Geography', 'id': 3},
+            'questions': 2
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'], 2)
+        room = '/rooms/{}'.format(data['room_id'])
+        host_token = data['host_token']
+
+        players = [json.loads(client.post(room + '/players', json={
+            'name': name}).data)['player_id'] for name in ('Ada', 'Alan')]
+
+        response = client.post(room + '/answers', json={
+            'player_id': players[0], 'answer': 'Lake Victoria'})
+        self.assertEqual(response.status_code, 422)
+        response = client.post(room + '/next', json={'host_token': 'guess'})
+        self.assertEqual(response.status_code, 403)
+
+        asked = []
+        for _ in range(2):
+            data = json.loads(client.post(room + '/next', json={
+                'host_token': host_token}).data)
+            question = data['question']
+            self.assertEqual(question['category'], 3)
+            asked.append(question['id'])
+
+            response = client.post(room + '/answers', json={
+                'player_id': players[0], 'answer': question['answer']})
+            self.assertTrue(json.loads(response.data)['correct'])
+            response = client.post(room + '/answers', json={
+                'player_id': players[1], 'answer': 'Atlantis'})
+            self.assertFalse(json.loads(response.data)['correct'])
+            response = client.post(room + '/answers', json={
+                'player_id': players[1], 'answer': 'Atlantis'})
+            self.assertEqual(response.status_code, 422)
+
+        data = json.loads(client.post(room + '/next', json={
+            'host_token': host_token}).data)
+        self.assertIsNone(data['question'])
+        response = client.post(room + '/next', json={
+            'host_token': host_token})
+        self.assertEqual(response.status_code, 422)
+        data = json.loads(client.get(room).data)
+        self.assertEqual(data['players'], 2)
+        self.assertTrue(data['finished'])
+
+        response = client.get(room + '/events')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = self.room_events(response.data)
+        self.assertEqual([name for _, name, _ in events], [
+            'question', 'results', 'question', 'results', 'finished'])
+        self.assertEqual([data['question']['id'] for _, name, data
+                          in events if name == 'question'], asked)
+        self.assertNotIn('answer', events[0][2]['question'])
+        self.assertEqual(events[1][2]['answers'], 2)
+        self.assertEqual(events[1][2]['correct'], 1)
+        self.assertEqual(events[4][2]['leaderboard'][0],
+                         {'name': 'Ada', 'score': 2})
+
+        # reconnections resume after the last event received
+        response = client.get(room + '/events',
+                              headers={'Last-Event-ID': '4'})
+        self.assertEqual([name for _, name, _
+                          in self.room_events(response.data)], ['finished'])
+
+    def test_quiz_room_errors(self):
+        """
+        multiplayer quiz room error test function
+        """
+        response = self.client().post('/rooms', json={
+            'quiz_category': {'id': 1000}})
+        self.assertEqual(response.status_code, 404)
+        response = self.client().post('/rooms', json={
+            'quiz_category': {'id': 3}, 'questions': 0})
+        self.assertEqual(response.status_code, 400)
+
+        for path in ('/rooms/abcde', '/rooms/abcde/events'):
+            response = self.client().get(path)
+            self.assertEqual(response.status_code, 404)
+        response = self.client().post('/rooms/abcde/players',
+                                      json={'name': 'Ada'})
+        self.assertEqual(response.status_code, 404)
+
+        data = json.loads(self.client().post('/rooms', json={
+            'quiz_category': {'id': 3}}).data)
+        room = '/rooms/{}'.format(data['room_id'])
+        response = self.client().post(room + '/players', json={'name': ' '})
+        self.assertEqual(response.status_code, 400)
+        response = self.client().post(room + '/answers', json={
+            'player_id': 'nobody', 'answer': 'Paris'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(json.loads(response.data)['message'], 'Forbidden')
+
+    def test_jobs(self):
+        """
+        background maintenance jobs test function
+        """
+        with self.app.app_context():
+            Category.query.update({Category.question_count: 0})
+            db.session.commit()
+
+        response = self.client().post('/jobs',
+                                      json={'kind': 'reconcile_counts'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['job']['status'], 'queued')
+        self.assertEqual(data['job']['arguments'], {})
+        self.assertIsNone(data['job']['updated_at'])
+        job_url = '/jobs/{}'.format(data['job']['id'])
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['jobs', 'submit', 'rebuild_indexes'])
+        self.assertIn('Queued job', result.output)
+        result = runner.invoke(args=['jobs', 'run', '--once'])
+        self.assertIn('Ran 2 jobs', result.output)
+        self.assertIn('rebuild_indexes succeeded',
+                      runner.invoke(args=['jobs', 'list']).output)
+
+        data = json.loads(self.client().get(job_url).data)
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertEqual(data['job']['progress'], 6)
+        self.assertEqual(data['job']['total'], 6)
+        self.assertEqual(data['job']['result'], {'categories': 6})
+        self.assertTrue(data['job']['updated_at'] >=
+                        data['job']['started_at'])
+        with self.app.app_context():
+            self.assertEqual(Category.query.get(2).question_count, 4)
+            self.assertEqual(len(self.app.extensions['quiz_pools']),
+                             Question.query.count())
+
+        data = json.loads(self.client().get('/jobs?status=succeeded').data)
+        self.assertTrue(data['total_jobs'] >= 2)
+        self.assertIn('rebuild_indexes',
+                      [listed['kind'] for listed in data['jobs']])
+
+    def test_jobs_errors(self):
+        """
+        background jobs error test function
+        """
+        response = self.client().post('/jobs', json={'kind': 'drop_tables'})
+        self.assertEqual(response.status_code, 400)
+        for kind, arguments in (('reconcile_counts', [1]),
+                                ('reconcile_counts', {'batch_size': 10}),
+                                ('refresh_search_vectors',
+                                 {'batch_count': 10}),
+                                ('refresh_search_vectors',
+                                 {'batch_size': '10'}),
+                                ('refresh_search_vectors',
+                                 {'batch_size': 0})):
+            response = self.client().post('/jobs', json={
+                'kind': kind, 'arguments': arguments})
+            self.assertEqual(response.status_code, 400, arguments)
+        self.assertEqual(self.client().get('/jobs?status=lost').status_code,
+                         400)
+        self.assertEqual(self.client().get('/jobs/100000').status_code, 404)
+
+        # a job raising an error is marked failed
+        with self.app.app_context():
+            job_id = submit_job('refresh_search_vectors',
+                                {'batch_count': 10}).id
+        self.app.test_cli_runner().invoke(args=['jobs', 'run', '--once'])
+        data = json.loads(self.client().get('/jobs/{}'.format(job_id)).data)
+        self.assertEqual(data['job']['status'], 'failed')
+        self.assertIn('TypeError', data['job']['error'])
+
+    def test_instrumentation(self):
+        """
+        request instrumentation and metrics endpoint test function
+        """
+        client = self.create_test_app(INSTRUMENTATION=True).test_client()
+
+        response = client.get('/questions')
+        timing = response.headers['Server-Timing']
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('db;dur=', timing)
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertNotIn('desc="0 queries"', timing)
+
+        response = client.get('/metrics')
+        metrics = response.data.decode('utf-8')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('trivia_request_duration_seconds_count{route="/questions",method="GET",status="200"} 1', metrics)  # noqa
+        self.assertIn('trivia_db_queries_total{route="/questions"', metrics)
+
+    def test_instrumentation_failed_statement(self):
+        """
+        failed statements leave no timing behind test function
+        """
+        app = self.create_test_app(INSTRUMENTATION=True)
+        with app.app_context():
+            with db.engine.connect() as connection:
+                for _ in range(3):
+                    with self.assertRaises(Exception):
+                        connection.execute('SELECT * FROM missing_table')
+                self.assertEqual(
+                    connection.execute('SELECT 1').scalar(), 1)
+                self.assertFalse(connection.info.get('query_started'))
+
+    def test_instrumentation_profiles(self):
+        """
+        slow request profiling test function
+        """
+        app = self.create_test_app(INSTRUMENTATION=True,
+                                   PROFILE_THRESHOLD_MS=0)
+        app.test_client().get('/categories')
+
+        profiles = app.extensions['instrumentation'].slow_profiles
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['route'], '/categories')
+        self.assertIn('cumulative', profiles[0]['stats'])
+
+    def test_instrumentation_disabled(self):
+        """
+        metrics endpoint disabled by default test function
+        """
+        response = self.client().get('/questions')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(self.client().get('/metrics').status_code, 404)
+
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+
+@unittest.skipUnless(aiosqlite, 'aiosqlite is not installed')
+class AsyncTriviaTestCase(unittest.TestCase):
+    """This class represents the ASGI app test case, on a SQLite file"""
+
+    def setUp(self):
+        handle, self.database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.config = {'DATABASE_URL': 'sqlite:///' + self.database_file}
+
+        app = create_app(self.config)
+        with app.app_context():
+            load_dump('trivia.psql')
+        self.client = app.test_client
+        self.asgi_app = create_asgi_app(self.config)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi_app.database.disconnect())
+        self.loop.close()
+        os.remove(self.database_file)
+
+    def request(self, method, path, body=None):
+        """Send one request to the ASGI app, return its status and JSON."""
+        return self.loop.run_until_complete(self.call(method, path, body))
+
+    async def call(self, method, path, body=None):
+        """Send one request to the ASGI app, return its status and JSON."""
+        path, _, query_string = path.partition('?')
+        content = json.dumps(body).encode() if body is not None else b''
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string.encode(),
+            'headers': [(b'content-type', b'application/json')]
+        }
+        messages = [{'type': 'http.request', 'body': content}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await self.asgi_app(scope, receive, send)
+        return sent[0]['status'], json.loads(
+            b''.join(message['body'] for message in sent[1:]))
+
+    def test_async_routes_match_flask(self):
+        """
+        natively served routes return the JSON of the Flask app
+        """
+        for path in ('/categories', '/questions?page=2',
+                     '/questions?after_id=12&view=minimal',
+                     '/categories/3/questions', '/questions?page=1000'):
+            response = self.client().get(path)
+            status, data = self.request('GET', path)
+
+            self.assertEqual(status, response.status_code, path)
+            self.assertEqual(data, json.loads(response.data), path)
+
+    def test_async_streamed_response(self):
+        """
+        responses of the Flask app streamed chunk by chunk test function
+        """
+        threads = set()
+
+        def chunks():
+            for number in range(3):
+                threads.add(threading.get_ident())
+                yield '{}\n'.format(number)
+
+        flask_app = self.asgi_app.app
+        flask_app.add_url_rule('/streamed', 'streamed',
+                               lambda: flask_app.response_class(chunks()))
+        scope = {'type': 'http', 'method': 'GET', 'path': '/streamed',
+                 'query_string': b'', 'headers': []}
+        messages = [{'type': 'http.request', 'body': b''}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.asgi_app(scope, receive, send))
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual([(message['body'], message['more_body'])
+                          for message in sent[1:]],
+                         [(b'0\n', True), (b'1\n', True), (b'2\n', False)])
+        self.assertEqual(len(threads), 1)
+
+        status, data = self.request('GET', '/questions/export?format=json')
+        self.assertEqual(status, 200)
+        self.assertEqual(data, json.loads(
+            self.client().get('/questions/export?format=json').data))
+
+    def test_async_play_quiz(self):
+        """
+        async quiz test function
+        """
+        status, data = self.request('POST', '/quizzes', {
+            'previous_questions': [16, 17],
+            'quiz_category': {'id': 2}
+        })
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['question']['category'], 2)
+        self.assertIn(data['question']['id'], (18, 19))
+
+        # ids sent as strings are excluded too, as by the Flask app
+        status, data = self.request('POST', '/quizzes', {
+            'previous_questions': ['16', '17', '18'],
+            'quiz_category': {'id': 2}
+        })
+        self.assertEqual(data['question']['id'], 19)
+        self.assertTrue(len(self.asgi_app.app.extensions['quiz_pools']))
+
+        status, data = self.request('POST', '/quizzes', {
+            'previous_questions': ['16', '17', '18', '19'],
+            'quiz_category': {'id': 2}
+        })
+        self.assertEqual(status, 200)
+        self.assertIsNone(data['question'])
+
+        status, data = self.request('POST', '/quizzes', {})
+        self.assertEqual(status, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_async_rate_limit(self):
+        """
+        async admission control test function
+        """
+        self.loop.run_until_complete(self.asgi_app.database.disconnect())
+        self.asgi_app = create_asgi_app(dict(self.config,
+                                             RATE_LIMIT_CLIENT=0.001,
+                                             RATE_LIMIT_CLIENT_BURST=2,
+                                             CONCURRENCY_LIMIT=1))
+        body = {'previous_questions': [], 'quiz_category': {'id': 2}}
+
+        status, data = self.request('POST', '/quizzes', body)
+        self.assertEqual(status, 200)
+        # handed to the Flask app without taking a second token
+        status, data = self.request('POST', '/quizzes',
+                                    dict(body, adaptive=True))
+        self.assertEqual(status, 200)
+
+        status, data = self.request('POST', '/quizzes', body)
+        self.assertEqual(status, 429)
+        self.assertEqual(data['message'], 'Too Many Requests')
+
+        gate = self.asgi_app.app.extensions['admission'].gate
+        self.assertTrue(gate.acquire())
+        gate.release()
+
+    def test_async_room_events(self):
+        """
+        quiz room events pushed from the event loop test function
+        """
+        status, data = self.request('POST', '/rooms', {
+            'quiz_category': {'id': 3}, 'questions': 2})
+        self.assertEqual(status, 200)
+        room = '/rooms/{}'.format(data['room_id'])
+        host = {'host_token': data['host_token']}
+        streams = [[] for _ in range(3)]
+
+        async def listen(stream):
+            scope = {'type': 'http', 'method': 'GET',
+                     'path': room + '/events', 'headers': []}
+            messages = [{'type': 'http.request', 'body': b''}]
+
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                # the client stays until the stream ends
+                await asyncio.Future()
+
+            async def send(message):
+                stream.append(message)
+
+            await self.asgi_app(scope, receive, send)
+
+        async def play():
+            listeners = [asyncio.ensure_future(listen(stream))
+                         for stream in streams]
+            await asyncio.sleep(0.01)
+            for _ in range(3):
+                await self.call('POST', room + '/next', host)
+            await asyncio.wait_for(asyncio.gather(*listeners), 5)
+
+        self.loop.run_until_complete(play())
+
+        for stream in streams:
+            self.assertEqual(stream[0]['status'], 200)
+            self.assertIn((b'content-type', b'text/event-stream'),
+                          stream[0]['headers'])
+            self.assertFalse(stream[-1].get('more_body'))
+            body = b''.join(message.get('body', b'')
+                            for message in stream[1:]).decode('utf-8')
+            self.assertEqual(
+                [line[len('event: '):] for line in body.splitlines()
+                 if line.startswith('event: ')],
+                ['question', 'results', 'question', 'results', 'finished'])
+
+        status, data = self.request('GET', '/rooms/abcde/events')
+        self.assertEqual(status, 404)
+
+    def test_async_delegates_to_flask(self):
+        """
+        other routes are served by the Flask app
+        """
+        status, data = self.request('POST', '/questions?view=minimal', {
+            'question': 'Which planet is the largest?',
+            'answer': 'Jupiter',
+            'category': 1,
+            'difficulty': 1
+        })
+        self.assertEqual(status, 200)
+
+        status, data = self.request('POST', '/questions_by_phrase',
+                                    {'searchTerm': 'largest planet'})
+        self.assertEqual(status, 200)
+        self.assertEqual(data['total_questions'], 1)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case, on two
+    SQLite files"""
+
+    def setUp(self):
+        self.database_files = []
+        for _ in range(2):
+            handle, database_file = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
+            self.database_files.append(database_file)
+            app = create_app({'DATABASE_URL': 'sqlite:///' + database_file})
+            with app.app_context():
+                load_dump('trivia.psql')
+        self.primary, self.replica = self.database_files
+
+        # the replica misses question 2
+        with sqlite3.connect(self.replica) as connection:
+            connection.execute('DELETE FROM questions WHERE id = 2')
+
+    def tearDown(self):
+        for database_file in self.database_files:
+            os.remove(database_file)
+
+    def create_replicated_app(self, **config):
+        config['DATABASE_URL'] = 'sqlite:///' + self.primary
+        config['DATABASE_REPLICA_URLS'] = 'sqlite:///' + self.replica
+        return create_app(config)
+
+    def question_ids(self, client, path='/questions'):
+        response = client.get(path)
+        if response.status_code != 200:
+            return []
+        return [question['id'] for question
+                in json.loads(response.data)['questions']]
+
+    def test_sqlite_pool_settings(self):
+        """
+        pool settings on SQLite primaries and replicas test function
+        """
+        app = self.create_replicated_app(DATABASE_POOL_SIZE=5,
+                                         DATABASE_MAX_OVERFLOW=2,
+                                         DATABASE_POOL_TIMEOUT=3,
+                                         DATABASE_POOL_PRE_PING=True)
+        client = app.test_client()
+        self.assertTrue(self.question_ids(client))
+        self.assertEqual(client.post('/questions', json={
+            'question': 'pooled question',
+            'answer': 'pooled answer',
+            'category': 1,
+            'difficulty': 1
+        }).status_code, 200)
+
+    def test_reads_go_to_replica(self):
+        """
+        read requests routed to the replica test function
+        """
+        app = self.create_replicated_app()
+        self.assertNotIn(2, self.question_ids(app.test_client()))
+
+        response = app.test_client().post('/quizzes', json={
+            'previous_questions': [4, 5, 6, 9],
+            'quiz_category': {'id': 5}
+        })
+        self.assertIsNone(json.loads(response.data)['question'])
+
+    def test_read_your_writes(self):
+        """
+        reads after a write stay on the primary test function
+        """
+        app = self.create_replicated_app()
+        client = app.test_client()
+        response = client.post('/questions?view=minimal', json={
+            'question': 'Where was this written?',
+            'answer': 'On the primary',
+            'category': 1,
+            'difficulty': 1
+        })
+        created = json.loads(response.data)['created']
+        path = '/questions?after_id={}'.format(created - 1)
+
+        self.assertEqual(self.question_ids(client, path), [created])
+        self.assertIn(2, self.question_ids(client))
+        self.assertEqual(self.question_ids(app.test_client(), path), [])
+
+    def test_lag_aware_fallback(self):
+        """
+        lagging replica skipped test function
+        """
+        app = self.create_replicated_app(REPLICA_LAG_AWARE=True,
+                                         REPLICA_LAG_CHECK_INTERVAL=0)
+        self.assertNotIn(2, self.question_ids(app.test_client()))
+
+        app.test_client().delete('/questions/5')
+        # the replica did not see the delete, its versions are behind
+        self.assertIn(2, self.question_ids(app.test_client()))
+
+    def test_replica_strategies(self):
+        """
+        round-robin and least-connections replica choice test function
+        """
+        primary = db.create_engine('sqlite://', {})
+        engines = [db.create_engine('sqlite://', {}) for _ in range(2)]
+
+        router = ReplicaRouter(engines)
+        self.assertEqual([router.engine_for_read(primary)
+                          for _ in range(3)], engines + engines[:1])
+
+        router = ReplicaRouter(engines, strategy='least-connections')
+        connection = engines[0].connect()
+        self.assertIs(router.engine_for_read(primary), engines[1])
+        connection.close()
+        self.assertIs(router.engine_for_read(primary), engines[0])
+
+
+class JobRunnerTestCase(unittest.TestCase):
+    """This class represents the background job workers test case, on a
+    SQLite file"""
+
+    def setUp(self):
+        handle, self.database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        config = {'DATABASE_URL': 'sqlite:///' + self.database_file}
+        app = create_app(config)
+        with app.app_context():
+            load_dump('trivia.psql')
+
+        self.app = create_app(dict(config, JOB_WORKERS=2,
+                                   JOB_POLL_INTERVAL=0.05))
+        self.runner = self.app.extensions['job_runner']
+
+    def tearDown(self):
+        self.runner.stop(timeout=5)
+        os.remove(self.database_file)
+
+    def test_job_workers(self):
+        """
+        queued jobs run by the worker threads test function
+        """
+        client = self.app.test_client()
+        job_ids = [json.loads(client.post('/jobs', json={
+            'kind': kind, 'arguments': arguments}).data)['job']['id']
+            for kind, arguments in (('refresh_search_vectors',
+                                     {'batch_size': 5}),
+                                    ('reconcile_counts', {}),
+                                    ('rebuild_indexes', {}))]
+
+        deadline = time.monotonic() + 10
+        statuses = []
+        while time.monotonic() < deadline:
+            statuses = [json.loads(client.get('/jobs/{}'.format(
+                job_id)).data)['job']['status'] for job_id in job_ids]
+            if all(status in ('succeeded', 'failed') for status in statuses):
+                break
+            time.sleep(0.05)
+        self.assertEqual(statuses, ['succeeded'] * 3)
+
+        with self.app.app_context():
+            # every job was claimed once, by one of the workers
+            self.assertEqual([claimed.attempts for claimed in
+                              Job.query.order_by(Job.id)], [1, 1, 1])
+            self.assertEqual(Job.query.get(job_ids[0]).format()['arguments'],
+                             {'batch_size': 5})
+
+
+class WorkersTestCase(unittest.TestCase):
+    """This class represents two worker processes sharing a SQLite file,
+    each one with its own in-memory indexes"""
+
+    def setUp(self):
+        handle, self.database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        config = {'DATABASE_URL': 'sqlite:///' + self.database_file,
+                  'DATASET_VERSION_TTL': 0}
+        self.app = create_app(config)
+        with self.app.app_context():
+            load_dump('trivia.psql')
+        self.other_app = create_app(config)
+
+    def tearDown(self):
+        os.remove(self.database_file)
+
+    def create_question(self, question, answer, category):
+        response = self.other_app.test_client().post('/questions', json={
+            'question': question, 'answer': answer,
+            'category': category, 'difficulty': 1})
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_index_other_worker(self):
+        """
+        search index rebuilt after the writes of another worker test
+        function
+        """
+        client = self.app.test_client()
+        response = client.post('/questions_by_phrase',
+                               json={'searchTerm': 'zebra'})
+        # no match
+        self.assertEqual(json.loads(response.data)['success'], False)
+
+        self.create_question('Zebra stripes?', 'black and white', 6)
+        response = client.post('/questions_by_phrase',
+                               json={'searchTerm': 'zebra'})
+        self.assertEqual(json.loads(response.data)['total_questions'], 1)
+
+    def test_suggestion_index_other_worker(self):
+        """
+        suggestion index rebuilt after the writes of another worker test
+        function
+        """
+        client = self.app.test_client()
+        url = '/questions/suggest?prefix=zebr'
+        self.assertEqual(json.loads(client.get(url).data)['suggestions'], [])
+
+        self.create_question('Zebra stripes?', 'black and white', 6)
+        self.assertEqual(json.loads(client.get(url).data)['suggestions'],
+                         ['zebra'])
+
+    def test_rebuild_indexes_job(self):
+        """
+        indexes of every worker rebuilt by the rebuild_indexes job test
+        function
+        """
+        client = self.app.test_client()
+        url = '/questions/suggest?prefix=zebr'
+        self.assertEqual(json.loads(client.get(url).data)['suggestions'], [])
+
+        # written behind the app's back, the version does not move
+        with self.app.app_context():
+            db.session.execute(Question.__table__.insert().values(
+                question='Zebra stripes?', answer='black and white',
+                category=6, difficulty=1))
+            db.session.commit()
+        self.assertEqual(json.loads(client.get(url).data)['suggestions'], [])
+
+        runner = self.other_app.test_cli_runner()
+        runner.invoke(args=['jobs', 'submit', 'rebuild_indexes'])
+        result = runner.invoke(args=['jobs', 'run', '--once'])
+        self.assertIn('Ran 1 jobs', result.output)
+        self.assertEqual(json.loads(client.get(url).data)['suggestions'],
+                         ['zebra'])
+
+    def test_adaptive_quiz_other_worker(self):
+        """
+        adaptive quiz index rebuilt after the writes of another worker test
+        function
+        """
+        client = self.app.test_client()
+        body = {'previous_questions': list(range(1, 24)),
+                'quiz_category': {'id': 6}, 'adaptive': True}
+        data = json.loads(client.post('/quizzes', json=body).data)
+        self.assertIsNone(data['question'])
+
+        self.create_question('Zebra stripes?', 'black and white', 6)
+        data = json.loads(client.post('/quizzes', json=body).data)
+        self.assertEqual(data['question']['question'], 'Zebra stripes?')
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """This class smoke tests the benchmark harness"""
+
+    def test_run_benchmark(self):
+        """
+        benchmark report test function
+        """
+        report = run_benchmark('sqlite://', questions=200, requests=5,
+                               quiz_index_sizes=[1000])
+
+        self.assertEqual(report['config']['questions'], 200)
+        self.assertTrue(report['peak_rss_kb'])
+        for name, scenario in report['scenarios'].items():
+            self.assertEqual(scenario['errors'], 0, name)
+            self.assertTrue(scenario['p50_ms'] <= scenario['p99_ms'])
+        self.assertIn('quizzes_adaptive', report['scenarios'])
+        self.assertTrue(report['quiz_index'][1000]['p50_us'] > 0)
+        # two int32 ids per question, in its category and in all
+        self.assertEqual(report['quiz_pools'][1000]['bytes'], 8000)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
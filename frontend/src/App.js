@@ -11,6 +11,7 @@ import FormView from './components/FormView';
 import QuestionView from './components/QuestionView';
 import Header from './components/Header';
 import QuizView from './components/QuizView';
+import RoomView from './components/RoomView';
 
 
 class App extends Component {
@@ -23,6 +24,7 @@ class App extends Component {
           <Route path="/" exact component={QuestionView} />
           <Route path="/add" component={FormView} />
           <Route path="/play" component={QuizView} />
+          <Route path="/rooms" component={RoomView} />
           <Route component={QuestionView} />
         </Switch>
       </Router>
@@ -15,6 +15,7 @@ class Header extends Component {
         <h2 onClick={() => {this.navTo('')}}>List</h2>
         <h2 onClick={() => {this.navTo('/add')}}>Add</h2>
         <h2 onClick={() => {this.navTo('/play')}}>Play</h2>
+        <h2 onClick={() => {this.navTo('/rooms')}}>Rooms</h2>
       </div>
     );
   }
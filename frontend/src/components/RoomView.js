@@ -0,0 +1,245 @@
+import React, { Component } from 'react';
+import $ from 'jquery';
+
+import '../stylesheets/QuizView.css';
+
+const questionsPerRoom = 10;
+
+class RoomView extends Component {
+  constructor(props){
+    super();
+    this.state = {
+        categories: {},
+        roomId: '',
+        hostToken: null,
+        playerId: null,
+        name: '',
+        question: null,
+        questionNumber: 0,
+        totalQuestions: 0,
+        guess: '',
+        answered: false,
+        correct: null,
+        results: null,
+        leaderboard: null
+    }
+  }
+
+  componentDidMount(){
+    $.ajax({
+      url: `/categories`,
+      type: "GET",
+      success: (result) => {
+        this.setState({ categories: result.categories })
+        return;
+      },
+      error: (error) => {
+        alert('Unable to load categories. Please try your request again')
+        return;
+      }
+    })
+  }
+
+  componentWillUnmount(){
+    if (this.events) {
+      this.events.close()
+    }
+  }
+
+  handleChange = (event) => {
+    this.setState({[event.target.name]: event.target.value})
+  }
+
+  // every player of the room gets the same questions pushed by the server
+  listen = () => {
+    this.events = new EventSource(`/rooms/${this.state.roomId}/events`)
+    this.events.addEventListener('question', (event) => {
+      const data = JSON.parse(event.data)
+      this.setState({
+        question: data.question,
+        questionNumber: data.number,
+        totalQuestions: data.total,
+        guess: '',
+        answered: false,
+        correct: null,
+        results: null
+      })
+    })
+    this.events.addEventListener('results', (event) => {
+      this.setState({ results: JSON.parse(event.data), question: null })
+    })
+    this.events.addEventListener('finished', (event) => {
+      this.setState({ leaderboard: JSON.parse(event.data).leaderboard })
+      this.events.close()
+    })
+  }
+
+  createRoom = ({type, id=0}) => {
+    $.ajax({
+      url: '/rooms',
+      type: "POST",
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        quiz_category: {type, id},
+        questions: questionsPerRoom
+      }),
+      success: (result) => {
+        this.setState({
+          roomId: result.room_id,
+          hostToken: result.host_token,
+          totalQuestions: result.total_questions
+        }, this.listen)
+        return;
+      },
+      error: (error) => {
+        alert('Unable to create the room. Please try your request again')
+        return;
+      }
+    })
+  }
+
+  joinRoom = (event) => {
+    event.preventDefault();
+    $.ajax({
+      url: `/rooms/${this.state.roomId}/players`,
+      type: "POST",
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({name: this.state.name}),
+      success: (result) => {
+        this.setState({ playerId: result.player_id }, this.listen)
+        return;
+      },
+      error: (error) => {
+        alert('Unable to join the room. Please check its code and try again')
+        return;
+      }
+    })
+  }
+
+  nextQuestion = () => {
+    $.ajax({
+      url: `/rooms/${this.state.roomId}/next`,
+      type: "POST",
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({host_token: this.state.hostToken}),
+      error: (error) => {
+        alert('Unable to move to the next question. Please try again')
+        return;
+      }
+    })
+  }
+
+  submitGuess = (event) => {
+    event.preventDefault();
+    $.ajax({
+      url: `/rooms/${this.state.roomId}/answers`,
+      type: "POST",
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        player_id: this.state.playerId,
+        answer: this.state.guess
+      }),
+      success: (result) => {
+        this.setState({ answered: true, correct: result.correct })
+        return;
+      },
+      error: (error) => {
+        alert('Unable to send the answer. Please try again')
+        return;
+      }
+    })
+  }
+
+  renderPreRoom(){
+    return (
+      <div className="quiz-play-holder">
+        <div className="choose-header">Host a room</div>
+        <div className="category-holder">
+          <div className="play-category" onClick={this.createRoom}>ALL</div>
+          {Object.keys(this.state.categories).map(id => {
+            return (
+              <div
+                key={id}
+                value={id}
+                className="play-category"
+                onClick={() => this.createRoom({type:this.state.categories[id], id})}>
+                {this.state.categories[id]}
+              </div>
+            )
+          })}
+        </div>
+        <div className="choose-header">Join a room</div>
+        <form onSubmit={this.joinRoom}>
+          <input type="text" name="roomId" placeholder="Room code" onChange={this.handleChange}/>
+          <input type="text" name="name" placeholder="Your name" onChange={this.handleChange}/>
+          <input className="submit-guess button" type="submit" value="Join" />
+        </form>
+      </div>
+    )
+  }
+
+  renderLeaderboard(leaderboard){
+    return (
+      <ol>
+        {leaderboard.map((player, index) => (
+          <li key={index}>{player.name}: {player.score}</li>
+        ))}
+      </ol>
+    )
+  }
+
+  renderRoom(){
+    const { question, results, leaderboard } = this.state
+    if (leaderboard) {
+      return (
+        <div className="quiz-play-holder">
+          <div className="final-header">Final scores</div>
+          {this.renderLeaderboard(leaderboard)}
+        </div>
+      )
+    }
+
+    return (
+      <div className="quiz-play-holder">
+        <div className="choose-header">Room {this.state.roomId}</div>
+        {question && (
+          <div>
+            <div>Question {this.state.questionNumber} of {this.state.totalQuestions}</div>
+            <div className="quiz-question">{question.question}</div>
+            {this.state.playerId && (this.state.answered
+              ? <div className={`${this.state.correct ? 'correct' : 'wrong'}`}>{this.state.correct ? "You were correct!" : "You were incorrect"}</div>
+              : (
+                <form onSubmit={this.submitGuess}>
+                  <input type="text" name="guess" onChange={this.handleChange}/>
+                  <input className="submit-guess button" type="submit" value="Submit Answer" />
+                </form>
+              ))}
+          </div>
+        )}
+        {results && (
+          <div>
+            <div className="quiz-answer">{results.answer}</div>
+            <div>{results.correct} of {results.answers} players were correct</div>
+            {this.renderLeaderboard(results.leaderboard)}
+          </div>
+        )}
+        {!question && !results && <div>Waiting for the first question...</div>}
+        {this.state.hostToken && (
+          <div className="next-question button" onClick={this.nextQuestion}> Next Question </div>
+        )}
+      </div>
+    )
+  }
+
+  render() {
+    return this.state.hostToken || this.state.playerId
+        ? this.renderRoom()
+        : this.renderPreRoom()
+  }
+}
+
+export default RoomView;
@@ -1,8 +1,10 @@
 import React, { Component } from 'react'
+import $ from 'jquery';
 
 class Search extends Component {
   state = {
     query: '',
+    suggestions: [],
   }
 
   getInfo = (event) => {
@@ -10,10 +12,29 @@ class Search extends Component {
     this.props.submitSearch(this.state.query)
   }
 
+  getSuggestions = (prefix) => {
+    // only the answer to the latest keystroke matters
+    if (this.pendingSuggestions) {
+      this.pendingSuggestions.abort()
+    }
+    this.pendingSuggestions = $.ajax({
+      url: `/questions/suggest?prefix=${encodeURIComponent(prefix)}`,
+      type: "GET",
+      success: (result) => {
+        this.setState({ suggestions: result.suggestions })
+        return;
+      },
+      error: (error) => {
+        return;
+      }
+    })
+  }
+
   handleInputChange = () => {
     this.setState({
       query: this.search.value
     })
+    this.getSuggestions(this.search.value)
   }
 
   render() {
@@ -23,7 +44,13 @@ class Search extends Component {
           placeholder="Search questions..."
           ref={input => this.search = input}
           onChange={this.handleInputChange}
+          list="search-suggestions"
         />
+        <datalist id="search-suggestions">
+          {this.state.suggestions.map(suggestion => (
+            <option key={suggestion} value={suggestion}/>
+          ))}
+        </datalist>
         <input type="submit" value="Submit" className="button"/>
       </form>
     )